@@ -0,0 +1,433 @@
+__author__ = "Christopher Tomkins-Tinch, Johannes Köster"
+__copyright__ = "Copyright 2023, Christopher Tomkins-Tinch, Johannes Köster"
+__email__ = "johannes.koester@uni-due.de"
+__license__ = "MIT"
+
+import asyncio
+import hashlib
+import json
+import os
+import shutil
+import uuid
+from pathlib import Path
+from typing import Any, AsyncIterator, Dict, Iterable, List, Optional
+
+from snakemake_interface_common.exceptions import WorkflowError
+from snakemake_interface_storage_plugins.checksum import ChecksumCache
+from snakemake_interface_storage_plugins.common import Operation
+from snakemake_interface_storage_plugins.exceptions import CircuitOpenError
+from snakemake_interface_storage_plugins.hedging import RequestHedger
+from snakemake_interface_storage_plugins.io import IOCacheStorageInterface
+from snakemake_interface_storage_plugins.storage_object import (
+    DEFAULT_LIST_PAGE_SIZE,
+    StorageObjectBase,
+    StorageObjectGlob,
+    StorageObjectRead,
+    StorageObjectStat,
+    StorageObjectTouch,
+    StorageObjectWrite,
+)
+from snakemake_interface_storage_plugins.storage_provider import (
+    CHECKSUM_CACHE_DIR,
+    ExampleQuery,
+    StorageProviderBase,
+    StorageQueryValidationResult,
+)
+
+# directory (relative to the cache directory) for markers of objects that have
+# not been written back yet
+PENDING_WRITES_DIR = ".snakemake-pending"
+
+
+class CachingStorageProvider(StorageProviderBase):
+    """Storage provider that wraps another (remote) storage provider with a
+    faster cache tier, e.g. a node-local disk or a cluster-shared NFS directory.
+
+    Files are retrieved from the cache tier if the cached copy is still valid,
+    i.e. it has the checksum reported by the remote storage, or (if the remote
+    storage does not report checksums) the same size and a modification time
+    that is not older than that of the remote object. Otherwise, they are
+    retrieved from the remote storage and added to the cache tier.
+
+    Stored files are added to the cache tier as well. With write_back=False
+    (the default), they are written through to the remote storage right away.
+    With write_back=True, they are only written to the cache tier and uploaded
+    to the remote storage upon flush(). Until then, existence, size and
+    modification time are answered from the cache tier.
+
+    IMPORTANT: with write_back=True, the caller has to call flush() (e.g. at the
+    end of a job), nothing else uploads pending writes. Until then, they are only
+    visible to CachingStorageProviders using the same cache directory, but not
+    to any other process accessing the remote storage. Pending writes are
+    recorded in the cache directory, hence a pending write of a crashed process
+    can be uploaded by calling flush() of a new provider with the same cache
+    directory.
+
+    Directories bypass the cache tier. Requests to the remote storage share the
+    rate limiters, schedulers and circuit breakers of the wrapped provider.
+    Files are stored with store_object() of the wrapped storage objects, i.e.
+    transport compression of the wrapped provider is not applied. The cache tier
+    is never evicted, this has to be done externally (e.g. by removing files that
+    have not been accessed for a while).
+    """
+
+    def __init__(
+        self,
+        remote: StorageProviderBase,
+        cache_dir: Path,
+        write_back: bool = False,
+    ):
+        self.remote = remote
+        self.cache_dir = Path(cache_dir)
+        self.write_back = write_back
+        self._cache_checksums: Optional[ChecksumCache] = None
+        try:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+        except OSError as e:
+            raise WorkflowError(f"Failed to create cache directory {cache_dir}", e)
+        super().__init__(
+            local_prefix=remote.local_prefix,
+            logger=remote.logger,
+            wait_for_free_local_storage=remote.wait_for_free_local_storage,
+            settings=remote.settings,
+            keep_local=remote.keep_local,
+            retrieve=remote.retrieve,
+            is_default=remote.is_default,
+        )
+
+    def example_queries(self) -> List[ExampleQuery]:
+        return self.remote.example_queries()
+
+    def rate_limiter_key(self, query: str, operation: Operation) -> Any:
+        return self.remote.rate_limiter_key(query, operation)
+
+    def default_max_requests_per_second(self) -> float:
+        return self.remote.default_max_requests_per_second()
+
+    def use_rate_limiter(self) -> bool:
+        return self.remote.use_rate_limiter()
+
+    def operation_slot(
+        self,
+        query: str,
+        operation: Operation,
+        priority: int = 0,
+        size: Optional[int] = None,
+    ):
+        return self.remote.operation_slot(
+            query, operation, priority=priority, size=size
+        )
+
+    def request_hedger(
+        self, query: str, operation: Operation
+    ) -> Optional[RequestHedger]:
+        return self.remote.request_hedger(query, operation)
+
+    def default_stat_cache_ttl(self) -> float:
+        return self.remote.default_stat_cache_ttl()
+
+    def max_bulk_size(self) -> int:
+        return self.remote.max_bulk_size()
+
+    def is_valid_query(self, query: str) -> StorageQueryValidationResult:
+        return self.remote.is_valid_query(query)
+
+    def postprocess_query(self, query: str) -> str:
+        return self.remote.postprocess_query(query)
+
+    def safe_print(self, query: str) -> str:
+        return self.remote.safe_print(query)
+
+    @property
+    def cache_checksums(self) -> ChecksumCache:
+        """Sidecar cache for checksums of the files in the cache tier."""
+        if self._cache_checksums is None:
+            self._cache_checksums = ChecksumCache(
+                self.cache_dir / CHECKSUM_CACHE_DIR, logger=self.logger
+            )
+        return self._cache_checksums
+
+    @classmethod
+    def get_storage_object_cls(cls):
+        return CachingStorageObject
+
+    def _pending_marker(self, query: str) -> Path:
+        name = hashlib.sha256(query.encode()).hexdigest()
+        return self.cache_dir / PENDING_WRITES_DIR / f"{name}.json"
+
+    @property
+    def pending_writes(self) -> List[str]:
+        """Queries of objects that have not been written back yet (by any
+        process using this cache directory)."""
+        queries = []
+        for marker in (self.cache_dir / PENDING_WRITES_DIR).glob("*.json"):
+            try:
+                queries.append(json.loads(marker.read_text())["query"])
+            except (OSError, ValueError, KeyError):
+                # removed in the meantime or still being written
+                continue
+        return queries
+
+    async def flush(
+        self, max_concurrency: int = 8
+    ) -> Dict[str, Optional[WorkflowError]]:
+        """Write all objects that have been stored in the cache tier only
+        (write_back=True) to the remote storage.
+
+        Returns a dict mapping each query to None if storing succeeded, or to
+        a WorkflowError otherwise. Objects that failed remain pending.
+        """
+        results: Dict[str, Optional[WorkflowError]] = {}
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def flush_object(query: str):
+            async with semaphore:
+                try:
+                    await self.object(query).managed_write_back()
+                    results[query] = None
+                except WorkflowError as e:
+                    results[query] = e
+
+        await asyncio.gather(*(flush_object(query) for query in self.pending_writes))
+        return results
+
+
+class CachingStorageObject(
+    StorageObjectRead, StorageObjectWrite, StorageObjectGlob, StorageObjectTouch
+):
+    """Storage object of the CachingStorageProvider, delegating to a storage
+    object of the wrapped provider."""
+
+    __slots__ = ("_inner",)
+
+    provider: CachingStorageProvider
+
+    def __post_init__(self):
+        self._inner = None
+
+    @property
+    def inner(self) -> StorageObjectBase:
+        """Storage object of the wrapped provider for the current query."""
+        # the query might be modified after creation
+        if self._inner is None or self._inner.query != self.query:
+            self._inner = self.provider.remote.get_storage_object_cls()(
+                query=self.query,
+                keep_local=self.keep_local,
+                retrieve=self.retrieve,
+                provider=self.provider.remote,
+            )
+        return self._inner
+
+    def cache_path(self) -> Path:
+        """Path of the object in the cache tier."""
+        return self.provider.cache_dir / self.inner.local_suffix()
+
+    def _pending(self) -> bool:
+        return self.provider._pending_marker(self.query).exists()
+
+    def _mark_pending(self):
+        marker = self.provider._pending_marker(self.query)
+        marker.parent.mkdir(parents=True, exist_ok=True)
+        tmp = marker.with_name(f".{marker.name}.{uuid.uuid4().hex}")
+        # the cache file version allows to detect a store during write back
+        tmp.write_text(
+            json.dumps(
+                {
+                    "query": self.query,
+                    "mtime_ns": self.cache_path().stat().st_mtime_ns,
+                }
+            )
+        )
+        os.replace(tmp, marker)
+
+    def _store_remote(self, path: Path):
+        # The single path for storing files in the remote storage, used for
+        # writing through and writing back.
+        with self.inner._local_path_overwritten(path):
+            self.inner.store_object()
+
+    async def managed_write_back(self):
+        """Upload the object if it has only been stored in the cache tier so far,
+        see CachingStorageProvider.flush()."""
+        marker = self.provider._pending_marker(self.query)
+        try:
+            version = marker.read_text()
+        except FileNotFoundError:
+            return
+        cached = self.cache_path()
+        try:
+            async with self._managed_operation(
+                Operation.STORE, size=cached.stat().st_size
+            ):
+                self._store_remote(cached)
+            if self.provider.verify_checksums():
+                storage_checksum = self.inner.checksum()
+                if storage_checksum is not None and (
+                    storage_checksum.split(":", 1)[0] in hashlib.algorithms_available
+                ):
+                    local_checksum = await self.provider.cache_checksums.checksum(
+                        cached, storage_checksum.split(":", 1)[0]
+                    )
+                    if local_checksum != storage_checksum:
+                        raise WorkflowError(
+                            f"Checksum mismatch: {local_checksum} (cache) != "
+                            f"{storage_checksum} (storage)"
+                        )
+        except CircuitOpenError:
+            raise
+        except Exception as e:
+            raise WorkflowError(
+                f"Failed to write back {self.print_query} to the remote storage", e
+            )
+        # keep the marker if the object has been stored again in the meantime
+        if marker.exists() and marker.read_text() == version:
+            marker.unlink(missing_ok=True)
+        self._invalidate_stat()
+
+    def local_suffix(self) -> str:
+        return self.inner.local_suffix()
+
+    async def inventory(self, cache: IOCacheStorageInterface):
+        if not self._pending():
+            await self.inner.inventory(cache)
+
+    def get_inventory_parent(self) -> Optional[str]:
+        return self.inner.get_inventory_parent()
+
+    def cleanup(self):
+        self.inner.cleanup()
+
+    def exists(self) -> bool:
+        return self._pending() or self.inner.exists()
+
+    def mtime(self) -> float:
+        if self._pending():
+            return self.cache_path().stat().st_mtime
+        return self.inner.mtime()
+
+    def size(self) -> int:
+        if self._pending():
+            return self.cache_path().stat().st_size
+        return self.inner.size()
+
+    def checksum(self) -> Optional[str]:
+        if self._pending():
+            return self.provider.cache_checksums.compute(self.cache_path())
+        return self.inner.checksum()
+
+    def local_footprint(self) -> int:
+        if self._pending():
+            return self.cache_path().stat().st_size
+        return self.inner.local_footprint()
+
+    def stat(self) -> StorageObjectStat:
+        if self._pending():
+            stat = self.cache_path().stat()
+            return StorageObjectStat(
+                exists=True, size=stat.st_size, mtime=stat.st_mtime
+            )
+        if type(self.inner).stat is not StorageObjectRead.stat:
+            return self.inner.stat()
+        # The remaining values are requested separately if needed.
+        return StorageObjectStat(exists=self.inner.exists())
+
+    def _is_cache_valid(self, cached: Path) -> bool:
+        if not cached.is_file():
+            return False
+        if self._pending():
+            return True
+        # usually memoized by managed_retrieve() already
+        stat = self._stat if self._stat is not None else self.stat()
+        if not stat.exists:
+            return False
+        if stat.checksum is not None:
+            algorithm = stat.checksum.split(":", 1)[0]
+            if algorithm in hashlib.algorithms_available:
+                return (
+                    self.provider.cache_checksums.compute(cached, algorithm)
+                    == stat.checksum
+                )
+        cached_stat = cached.stat()
+        size = stat.size if stat.size is not None else self.inner.size()
+        mtime = stat.mtime if stat.mtime is not None else self.inner.mtime()
+        return cached_stat.st_size == size and cached_stat.st_mtime >= mtime
+
+    def _add_to_cache(self, local_path: Path):
+        cached = self.cache_path()
+        cached.parent.mkdir(parents=True, exist_ok=True)
+        tmp = cached.with_name(f".{cached.name}.{uuid.uuid4().hex}")
+        try:
+            shutil.copyfile(local_path, tmp)
+            # atomic, the cache tier may be shared by multiple processes
+            os.replace(tmp, cached)
+        finally:
+            tmp.unlink(missing_ok=True)
+
+    def retrieve_object(self):
+        local_path = self.local_path()
+        cached = self.cache_path()
+        if self._is_cache_valid(cached):
+            shutil.copyfile(cached, local_path)
+            return
+        inner = self.inner
+        # objects are always copied, since retrieving them on demand (e.g. via a
+        # symlink or mount) would bypass the cache tier
+        inner.is_ondemand_eligible = False
+        with inner._local_path_overwritten(local_path):
+            inner.retrieve_object()
+        if local_path.is_file():
+            self._add_to_cache(local_path)
+
+    def store_object(self):
+        local_path = self.local_path()
+        if not local_path.is_file():
+            self._store_remote(local_path)
+            return
+        self._add_to_cache(local_path)
+        if self.provider.write_back:
+            self._mark_pending()
+        else:
+            self._store_remote(local_path)
+
+    def remove(self):
+        pending = self._pending()
+        self.provider._pending_marker(self.query).unlink(missing_ok=True)
+        self.cache_path().unlink(missing_ok=True)
+        # the object might only have been stored in the cache tier
+        if not pending or self.inner.exists():
+            self.inner.remove()
+
+    def list_candidate_matches(self) -> Iterable[str]:
+        if not isinstance(self.inner, StorageObjectGlob):
+            raise WorkflowError(
+                f"Storage provider {type(self.provider.remote).__name__} "
+                "does not support listing."
+            )
+        return self.inner.list_candidate_matches()
+
+    async def list_candidate_matches_paged(
+        self,
+        prefix: str,
+        delimiter: Optional[str] = None,
+        page_size: int = DEFAULT_LIST_PAGE_SIZE,
+    ) -> AsyncIterator[List[str]]:
+        if not isinstance(self.inner, StorageObjectGlob):
+            raise WorkflowError(
+                f"Storage provider {type(self.provider.remote).__name__} "
+                "does not support listing."
+            )
+        async for page in self.inner.list_candidate_matches_paged(
+            prefix, delimiter=delimiter, page_size=page_size
+        ):
+            yield page
+
+    def touch(self):
+        if self._pending():
+            os.utime(self.cache_path())
+            return
+        if not isinstance(self.inner, StorageObjectTouch):
+            raise WorkflowError(
+                f"Storage provider {type(self.provider.remote).__name__} "
+                "does not support touching."
+            )
+        self.inner.touch()
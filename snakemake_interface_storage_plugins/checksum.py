@@ -0,0 +1,134 @@
+__author__ = "Christopher Tomkins-Tinch, Johannes Köster"
+__copyright__ = "Copyright 2023, Christopher Tomkins-Tinch, Johannes Köster"
+__email__ = "johannes.koester@uni-due.de"
+__license__ = "MIT"
+
+import asyncio
+import contextlib
+import hashlib
+import json
+import logging
+import mmap
+import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from logging import Logger
+from pathlib import Path
+from typing import Optional
+
+CHUNK_SIZE = 16 * 1024 * 1024
+
+
+@lru_cache(maxsize=None)
+def _get_executor() -> ThreadPoolExecutor:
+    # hashlib releases the GIL for large buffers, hence threads are sufficient
+    # for hashing multiple files in parallel.
+    return ThreadPoolExecutor(
+        max_workers=os.cpu_count(), thread_name_prefix="snakemake-checksum"
+    )
+
+
+def compute_checksum(
+    path: Path, algorithm: str = "sha256", chunk_size: int = CHUNK_SIZE
+) -> str:
+    """Compute the checksum of the given file in the form {algorithm}:{hexdigest}.
+
+    The file is memory-mapped and hashed in chunks.
+    """
+    digest = hashlib.new(algorithm)
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size:
+            with (
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped,
+                memoryview(mapped) as view,
+            ):
+                for offset in range(0, size, chunk_size):
+                    digest.update(view[offset : offset + chunk_size])
+    return f"{algorithm}:{digest.hexdigest()}"
+
+
+class ChecksumCache:
+    """Sidecar cache for checksums of local files.
+
+    Entries are stored as small JSON files in the given directory and are
+    only valid as long as size and modification time (in ns) of the file are
+    unchanged. This way, unchanged (possibly huge) files are not hashed again.
+    """
+
+    def __init__(self, cache_dir: Path, logger: Optional[Logger] = None) -> None:
+        self.cache_dir = cache_dir
+        self.logger = logger or logging.getLogger(__name__)
+
+    def _sidecar(self, path: Path) -> Path:
+        key = hashlib.sha256(str(path.resolve()).encode()).hexdigest()
+        return self.cache_dir / f"{key}.json"
+
+    def get(self, path: Path, algorithm: str) -> Optional[str]:
+        stat = path.stat()
+        try:
+            with open(self._sidecar(path)) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if (
+            entry.get("path") != str(path.resolve())
+            or entry.get("size") != stat.st_size
+            or entry.get("mtime_ns") != stat.st_mtime_ns
+        ):
+            return None
+        return entry.get("checksums", {}).get(algorithm)
+
+    def set(self, path: Path, checksum: str, stat: os.stat_result) -> None:
+        sidecar = self._sidecar(path)
+        entry = {
+            "path": str(path.resolve()),
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "checksums": {},
+        }
+        try:
+            with open(sidecar) as f:
+                existing = json.load(f)
+            if all(
+                existing.get(key) == entry[key] for key in ("path", "size", "mtime_ns")
+            ):
+                entry["checksums"] = existing.get("checksums", {})
+        except (OSError, ValueError):
+            pass
+        entry["checksums"][checksum.split(":", 1)[0]] = checksum
+
+        # write atomically, since multiple jobs or threads might compute the
+        # same checksum
+        tmp = sidecar.with_name(f"{sidecar.name}.{uuid.uuid4().hex}.tmp")
+        try:
+            sidecar.parent.mkdir(parents=True, exist_ok=True)
+            with open(tmp, "w") as f:
+                json.dump(entry, f)
+            os.replace(tmp, sidecar)
+        except OSError as e:
+            # this is only a cache, the checksum is computed again next time
+            self.logger.debug(f"Failed to cache checksum of {path}: {e}")
+            with contextlib.suppress(OSError):
+                tmp.unlink(missing_ok=True)
+
+    def compute(self, path: Path, algorithm: str = "sha256") -> str:
+        """Return the checksum of the given file, computing it if it is not
+        cached yet."""
+        cached = self.get(path, algorithm)
+        if cached is not None:
+            return cached
+        # record the stat before hashing, such that a modification during
+        # hashing invalidates the entry
+        stat = path.stat()
+        checksum = compute_checksum(path, algorithm)
+        self.set(path, checksum, stat)
+        return checksum
+
+    async def checksum(self, path: Path, algorithm: str = "sha256") -> str:
+        """Return the checksum of the given file, computing it in a thread pool
+        if it is not cached yet."""
+        return await asyncio.get_running_loop().run_in_executor(
+            _get_executor(), self.compute, path, algorithm
+        )
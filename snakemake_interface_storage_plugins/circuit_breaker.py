@@ -0,0 +1,95 @@
+__author__ = "Christopher Tomkins-Tinch, Johannes Köster"
+__copyright__ = "Copyright 2023, Christopher Tomkins-Tinch, Johannes Köster"
+__email__ = "johannes.koester@uni-due.de"
+__license__ = "MIT"
+
+import time
+from dataclasses import dataclass
+from enum import Enum
+from logging import Logger
+from typing import Any
+
+from snakemake_interface_storage_plugins.exceptions import CircuitOpenError
+
+
+@dataclass
+class CircuitBreakerPolicy:
+    # number of consecutive failures after which the circuit opens
+    failure_threshold: int = 5
+    # seconds to fail fast before letting probe requests through
+    reset_timeout: float = 30.0
+    # maximum number of concurrent probe requests while half-open
+    max_probes: int = 1
+
+
+class CircuitState(Enum):
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+
+class CircuitBreaker:
+    """Circuit breaker for the requests of a storage endpoint.
+
+    After failure_threshold consecutive failures, the circuit opens and all
+    requests fail fast with a CircuitOpenError. After reset_timeout seconds,
+    it becomes half-open and lets up to max_probes requests through. If a
+    probe succeeds, the circuit closes again, if it fails, it opens again.
+    """
+
+    def __init__(self, key: Any, policy: CircuitBreakerPolicy, logger: Logger):
+        self.key = key
+        self.policy = policy
+        self.logger = logger
+        self.state = CircuitState.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probes = 0
+
+    def before_call(self) -> None:
+        """Raise a CircuitOpenError if the request shall not be performed."""
+        if self.state == CircuitState.OPEN:
+            if time.monotonic() - self._opened_at < self.policy.reset_timeout:
+                raise CircuitOpenError(self.key, self._failures)
+            self._transition(CircuitState.HALF_OPEN)
+        if self.state == CircuitState.HALF_OPEN:
+            if self._probes >= self.policy.max_probes:
+                raise CircuitOpenError(self.key, self._failures)
+            self._probes += 1
+
+    def record_success(self) -> None:
+        self._failures = 0
+        if self.state != CircuitState.CLOSED:
+            self._transition(CircuitState.CLOSED)
+
+    def record_failure(self) -> None:
+        self._failures += 1
+        if self.state == CircuitState.HALF_OPEN or (
+            self.state == CircuitState.CLOSED
+            and self._failures >= self.policy.failure_threshold
+        ):
+            self._transition(CircuitState.OPEN)
+
+    def record_cancel(self) -> None:
+        # neither success nor failure, but a probe slot has to be freed
+        if self.state == CircuitState.HALF_OPEN and self._probes > 0:
+            self._probes -= 1
+
+    def _transition(self, state: CircuitState) -> None:
+        self.state = state
+        self._probes = 0
+        if state == CircuitState.OPEN:
+            self._opened_at = time.monotonic()
+            self.logger.warning(
+                f"Storage endpoint {self.key} failed {self._failures} times in a "
+                f"row, failing fast for {self.policy.reset_timeout}s (circuit open)."
+            )
+        elif state == CircuitState.HALF_OPEN:
+            self.logger.info(
+                f"Probing whether storage endpoint {self.key} has recovered "
+                "(circuit half-open)."
+            )
+        else:
+            self.logger.info(
+                f"Storage endpoint {self.key} has recovered (circuit closed)."
+            )
@@ -21,6 +21,33 @@ class Operation(Enum):
     REMOVE = "remove"
     SIZE = "size"
     TOUCH = "touch"
+    LIST = "list"
+
+    @property
+    def operation_class(self) -> "OperationClass":
+        """The class of the operation, used for per-class rate limits."""
+        return _OPERATION_CLASSES[self]
+
+
+class OperationClass(Enum):
+    METADATA = "metadata"
+    RETRIEVE = "retrieve"
+    STORE = "store"
+    LIST = "list"
+    REMOVE = "remove"
+
+
+_OPERATION_CLASSES = {
+    Operation.RETRIEVE: OperationClass.RETRIEVE,
+    Operation.STORE: OperationClass.STORE,
+    Operation.EXISTS: OperationClass.METADATA,
+    Operation.MTIME: OperationClass.METADATA,
+    Operation.SIZE: OperationClass.METADATA,
+    Operation.REMOVE: OperationClass.REMOVE,
+    # touching modifies the object, hence it is metered like a write
+    Operation.TOUCH: OperationClass.STORE,
+    Operation.LIST: OperationClass.LIST,
+}
 
 
 def get_disk_free(local_path: Path) -> int:
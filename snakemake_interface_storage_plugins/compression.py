@@ -0,0 +1,56 @@
+__author__ = "Christopher Tomkins-Tinch, Johannes Köster"
+__copyright__ = "Copyright 2023, Christopher Tomkins-Tinch, Johannes Köster"
+__email__ = "johannes.koester@uni-due.de"
+__license__ = "MIT"
+
+import gzip
+import shutil
+from pathlib import Path
+from typing import IO
+
+from snakemake_interface_common.exceptions import WorkflowError
+
+# object metadata keys for transport compression
+CODEC_METADATA_KEY = "snakemake-transport-codec"
+UNCOMPRESSED_SIZE_METADATA_KEY = "snakemake-uncompressed-size"
+
+CODECS = ("gzip", "zstd")
+
+_BUFSIZE = 1024 * 1024
+
+
+def _open(path: Path, mode: str, codec: str) -> IO[bytes]:
+    if codec == "gzip":
+        return gzip.open(path, mode, compresslevel=6)
+    if codec == "zstd":
+        try:
+            # Python >= 3.14
+            from compression import zstd  # type: ignore
+
+            return zstd.open(path, mode)
+        except ImportError:
+            pass
+        try:
+            import zstandard
+        except ImportError:
+            raise WorkflowError(
+                "Transport compression with zstd requires Python >= 3.14 or the "
+                "zstandard package (install snakemake-interface-storage-plugins[zstd])."
+            )
+        return zstandard.open(path, mode)
+    raise WorkflowError(
+        f"Unsupported transport compression codec {codec}, "
+        f"supported are: {', '.join(CODECS)}."
+    )
+
+
+def compress_file(src: Path, dst: Path, codec: str) -> None:
+    """Compress src into dst with the given codec, streaming the data."""
+    with open(src, "rb") as infile, _open(dst, "wb", codec) as outfile:
+        shutil.copyfileobj(infile, outfile, _BUFSIZE)
+
+
+def decompress_file(src: Path, dst: Path, codec: str) -> None:
+    """Decompress src into dst with the given codec, streaming the data."""
+    with _open(src, "rb", codec) as infile, open(dst, "wb") as outfile:
+        shutil.copyfileobj(infile, outfile, _BUFSIZE)
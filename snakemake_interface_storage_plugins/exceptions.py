@@ -1,5 +1,5 @@
 from pathlib import Path
-from typing import Optional
+from typing import Any, Optional
 
 from snakemake_interface_common.exceptions import WorkflowError
 
@@ -17,3 +17,12 @@ class FileOrDirectoryNotFoundError(WorkflowError):
 
     def is_for_path(self, path: Path) -> bool:
         return self.local_path.resolve() == path.resolve()
+
+
+class CircuitOpenError(WorkflowError):
+    def __init__(self, key: Any, failures: int):
+        self.key = key
+        super().__init__(
+            f"Storage endpoint {key} is unavailable ({failures} consecutive "
+            "failures), failing fast until it has recovered."
+        )
@@ -0,0 +1,92 @@
+__author__ = "Christopher Tomkins-Tinch, Johannes Köster"
+__copyright__ = "Copyright 2023, Christopher Tomkins-Tinch, Johannes Köster"
+__email__ = "johannes.koester@uni-due.de"
+__license__ = "MIT"
+
+import asyncio
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import AsyncContextManager, Callable, Deque, Optional, TypeVar
+
+T = TypeVar("T")
+
+
+@dataclass
+class HedgingPolicy:
+    # latency percentile after which a duplicate request is issued
+    percentile: float = 0.95
+    # maximum fraction of requests that may be duplicated
+    max_hedge_ratio: float = 0.05
+    # number of latency samples needed before hedging starts
+    min_samples: int = 20
+    # number of most recent latency samples to consider
+    window: int = 1000
+
+
+class RequestHedger:
+    """Issue a duplicate of a request that takes longer than the given percentile
+    of recent latencies, and return the result of whichever finishes first.
+
+    Requests are executed in a thread, each attempt (including duplicates)
+    takes its own slot (e.g. of the rate limiter).
+    """
+
+    def __init__(self, policy: HedgingPolicy) -> None:
+        self.policy = policy
+        self.requests = 0
+        self.hedged = 0
+        self._latencies: Deque[float] = deque(maxlen=policy.window)
+
+    def threshold(self) -> Optional[float]:
+        """Current latency threshold for hedging, None if not enough samples."""
+        if len(self._latencies) < self.policy.min_samples:
+            return None
+        latencies = sorted(self._latencies)
+        index = min(int(len(latencies) * self.policy.percentile), len(latencies) - 1)
+        return latencies[index]
+
+    def _may_hedge(self) -> bool:
+        return self.hedged < self.policy.max_hedge_ratio * self.requests
+
+    async def call(
+        self, func: Callable[[], T], slot: Callable[[], AsyncContextManager]
+    ) -> T:
+        self.requests += 1
+
+        async def attempt(started: asyncio.Event) -> T:
+            async with slot():
+                started.set()
+                start = time.monotonic()
+                result = await asyncio.to_thread(func)
+                self._latencies.append(time.monotonic() - start)
+                return result
+
+        started = asyncio.Event()
+        primary = asyncio.ensure_future(attempt(started))
+        threshold = self.threshold()
+        if threshold is None:
+            return await primary
+
+        # start measuring once the primary request actually runs
+        wait_started = asyncio.ensure_future(started.wait())
+        await asyncio.wait({primary, wait_started}, return_when=asyncio.FIRST_COMPLETED)
+        wait_started.cancel()
+        if not primary.done():
+            await asyncio.wait({primary}, timeout=threshold)
+        if primary.done() or not self._may_hedge():
+            return await primary
+
+        self.hedged += 1
+        hedge = asyncio.ensure_future(attempt(asyncio.Event()))
+        done, pending = await asyncio.wait(
+            {primary, hedge}, return_when=asyncio.FIRST_COMPLETED
+        )
+        succeeded = [task for task in done if task.exception() is None]
+        if not succeeded and pending:
+            # the other attempt may still succeed
+            return await pending.pop()
+        for task in pending:
+            # the thread cannot be interrupted, its result is discarded
+            task.cancel()
+        return (succeeded or list(done))[0].result()
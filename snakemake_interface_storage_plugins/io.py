@@ -5,7 +5,8 @@ __license__ = "MIT"
 
 import re
 from abc import abstractmethod
-from typing import Dict, Optional
+from functools import lru_cache
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 
 WILDCARD_REGEX = re.compile(
     r"""
@@ -25,6 +26,138 @@ WILDCARD_REGEX = re.compile(
 )
 
 
+class WildcardPattern:
+    """A pattern with wildcards (e.g. "foo/{sample}.txt") that has been analyzed
+    once, such that prefix computations and matching are cheap afterwards.
+
+    Use compile_pattern() to obtain (memoized) instances.
+    """
+
+    __slots__ = [
+        "pattern",
+        "constant_prefix",
+        "complete_constant_prefix",
+        "segments",
+        "wildcard_names",
+        "delimiter",
+        "_regex_source",
+        "_regex",
+    ]
+
+    def __init__(self, pattern: str) -> None:
+        self.pattern = pattern
+
+        regex = []
+        wildcard_names: List[str] = []
+        may_match_slash = False
+        last = 0
+        first_wildcard_start = None
+        for match in WILDCARD_REGEX.finditer(pattern):
+            if first_wildcard_start is None:
+                first_wildcard_start = match.start()
+            regex.append(re.escape(pattern[last : match.start()]))
+            name = match.group("name")
+            # wildcard names may contain dots, hence they cannot be used as
+            # group names directly
+            if name in wildcard_names:
+                regex.append(f"(?P=_{wildcard_names.index(name)})")
+            else:
+                constraint = match.group("constraint")
+                may_match_slash |= _may_match_slash(constraint)
+                if constraint is None:
+                    constraint = ".+"
+                regex.append(f"(?P<_{len(wildcard_names)}>{constraint})")
+                wildcard_names.append(name)
+            last = match.end()
+        regex.append(re.escape(pattern[last:]))
+
+        self.wildcard_names: Tuple[str, ...] = tuple(wildcard_names)
+        # compiled upon the first match, since many patterns are only used for
+        # prefix computations
+        self._regex_source = "".join(regex) + "$"
+        self._regex: Optional[re.Pattern] = None
+        self.segments: Tuple[str, ...] = tuple(pattern.split("/"))
+        self.constant_prefix: str = _constant_prefix(pattern, first_wildcard_start)
+        self.complete_constant_prefix: str = _constant_prefix(
+            pattern, first_wildcard_start, strip_incomplete_parts=True
+        )
+
+        # A delimiter may be used for listing (i.e. a non-recursive listing of the
+        # "directory" given by the complete constant prefix) if no match can
+        # contain a slash after that prefix.
+        self.delimiter: Optional[str] = (
+            "/"
+            if not may_match_slash
+            and "/" not in pattern[len(self.complete_constant_prefix) :]
+            else None
+        )
+
+    @property
+    def regex(self) -> re.Pattern:
+        if self._regex is None:
+            self._regex = re.compile(self._regex_source)
+        return self._regex
+
+    @property
+    def has_wildcards(self) -> bool:
+        return bool(self.wildcard_names)
+
+    def match(self, candidate: str) -> Optional[Dict[str, str]]:
+        """Match the given concrete query against the pattern.
+
+        Returns the wildcard values if the candidate matches, None otherwise.
+        """
+        match = self.regex.match(candidate)
+        if match is None:
+            return None
+        return dict(zip(self.wildcard_names, match.groups()))
+
+    def __repr__(self) -> str:
+        return f"WildcardPattern({self.pattern!r})"
+
+
+def _constant_prefix(
+    pattern: str, first_wildcard_start: Optional[int], strip_incomplete_parts=False
+) -> str:
+    if first_wildcard_start is None:
+        return pattern
+    prefix = pattern[:first_wildcard_start]
+    if strip_incomplete_parts:
+        if "/" in prefix:
+            prefix = prefix.rsplit("/", 1)[0] + "/"
+        else:
+            first_slash_idx = pattern.find("/")
+            if first_slash_idx != -1 and first_slash_idx > first_wildcard_start:
+                # the first slash is after the first wildcard, hence the prefix
+                # is incomplete
+                prefix = ""
+    return prefix
+
+
+# Wildcard constraints that can be shown to never match a slash: literal word
+# characters, alternatives, groups, quantifiers, the classes \d, \w and \s,
+# some escaped punctuation, and character classes made of those (ranges between
+# word characters cannot include the slash). Anything else (e.g. ".", negated
+# classes or ranges like "!-~") is considered to possibly match a slash.
+_SLASH_FREE_CONSTRAINT = re.compile(
+    r"(?:[\w|()+*?{},:^$-]|\\[dws._-]|\[-?(?:\w(?:-\w)?|\\[dws._-])+-?\])*"
+)
+
+
+def _may_match_slash(constraint: Optional[str]) -> bool:
+    # Conservative check whether a wildcard constraint may match a slash.
+    # The default constraint (.+) does.
+    if constraint is None:
+        return True
+    return _SLASH_FREE_CONSTRAINT.fullmatch(constraint) is None
+
+
+@lru_cache(maxsize=10000)
+def compile_pattern(pattern: str) -> WildcardPattern:
+    """Return the (memoized) compiled form of the given wildcard pattern."""
+    return WildcardPattern(pattern)
+
+
 def get_constant_prefix(pattern: str, strip_incomplete_parts: bool = False) -> str:
     """Return constant prefix of a pattern, removing everything from the first
     wildcard on.
@@ -32,22 +165,100 @@ def get_constant_prefix(pattern: str, strip_incomplete_parts: bool = False) -> s
     If strip_incomplete_parts is set, trailing parts that do not end with
     a slash (/) are removed as well.
     """
+    # This does not use compile_pattern(), since plugins call it once per query,
+    # and most queries are never matched against.
     first_wildcard = WILDCARD_REGEX.search(pattern)
-    if first_wildcard:
-        prefix = pattern[: first_wildcard.start()]
-        if strip_incomplete_parts:
-            if "/" in prefix:
-                prefix = prefix.rsplit("/", 1)[0] + "/"
-            else:
-                first_slash_idx = pattern.find("/")
-                if first_slash_idx != -1 and first_slash_idx > first_wildcard.start():
-                    # the first slash is after the first wildcard, hence the prefix
-                    # is incomplete
-                    prefix = ""
-    else:
-        prefix = pattern
+    return _constant_prefix(
+        pattern,
+        first_wildcard.start() if first_wildcard else None,
+        strip_incomplete_parts=strip_incomplete_parts,
+    )
 
-    return prefix
+
+class PatternIndex:
+    """A prefix trie over many wildcard patterns.
+
+    This allows to match a single listing of a storage against all patterns
+    in one pass, e.g. when glob_wildcards() is called with many patterns that
+    refer to the same bucket. Instead of listing the storage once per pattern,
+    list it once per prefix returned by listing_prefixes() and pass the
+    candidates to match() or match_all().
+    """
+
+    __slots__ = ["_root", "_patterns"]
+
+    # key of a trie node that holds the patterns ending in that node
+    _PATTERNS = ""
+
+    def __init__(self, patterns: Iterable[str] = ()) -> None:
+        self._root: Dict[str, dict] = {}
+        self._patterns: Dict[str, WildcardPattern] = {}
+        for pattern in patterns:
+            self.add(pattern)
+
+    def add(self, pattern: str) -> WildcardPattern:
+        compiled = compile_pattern(pattern)
+        if pattern in self._patterns:
+            return compiled
+        self._patterns[pattern] = compiled
+        node = self._root
+        for char in compiled.constant_prefix:
+            node = node.setdefault(char, {})
+        node.setdefault(self._PATTERNS, []).append(compiled)
+        return compiled
+
+    def __len__(self) -> int:
+        return len(self._patterns)
+
+    def __iter__(self) -> Iterator[WildcardPattern]:
+        return iter(self._patterns.values())
+
+    def listing_prefixes(self) -> List[str]:
+        """Return the minimal set of prefixes (with incomplete parts stripped)
+        whose listings together cover all patterns.
+        """
+        prefixes: List[str] = []
+        for prefix in sorted(
+            {compiled.complete_constant_prefix for compiled in self._patterns.values()}
+        ):
+            # sorting ensures that a prefix comes right before all its extensions
+            if not prefixes or not prefix.startswith(prefixes[-1]):
+                prefixes.append(prefix)
+        return prefixes
+
+    def match(self, candidate: str) -> Iterator[Tuple[WildcardPattern, Dict[str, str]]]:
+        """Yield all patterns (with the corresponding wildcard values) that match
+        the given candidate.
+
+        Only patterns with a constant prefix of the candidate are tried.
+        """
+        node = self._root
+        for i in range(len(candidate) + 1):
+            for compiled in node.get(self._PATTERNS, ()):
+                wildcards = compiled.match(candidate)
+                if wildcards is not None:
+                    yield compiled, wildcards
+            if i == len(candidate):
+                break
+            node = node.get(candidate[i])
+            if node is None:
+                break
+
+    def match_all(
+        self, candidates: Iterable[str]
+    ) -> Dict[str, List[Tuple[str, Dict[str, str]]]]:
+        """Match all candidates against all patterns in one pass.
+
+        Returns a dict mapping each pattern to a list of (candidate, wildcards)
+        items.
+        """
+        matches: Dict[str, List[Tuple[str, Dict[str, str]]]] = {
+            pattern: [] for pattern in self._patterns
+        }
+        for candidate in candidates:
+            for compiled, wildcards in self.match(candidate):
+                matches[compiled.pattern].append((candidate, wildcards))
+        return matches
 
 
 class Mtime:
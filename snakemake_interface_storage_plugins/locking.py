@@ -0,0 +1,180 @@
+__author__ = "Christopher Tomkins-Tinch, Johannes Köster"
+__copyright__ = "Copyright 2023, Christopher Tomkins-Tinch, Johannes Köster"
+__email__ = "johannes.koester@uni-due.de"
+__license__ = "MIT"
+
+import asyncio
+import hashlib
+import os
+import socket
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Optional, Set
+
+
+class RetrievalLock:
+    """Lock file for coordinating the retrieval of a storage object between
+    processes (e.g. cluster jobs) that share the same local prefix.
+
+    One process acquires the lock and retrieves the object, the others wait.
+    Waiting processes register themselves by appending their token to the lock
+    file. When the holder succeeds and there are waiting processes, it leaves a
+    marker with its token, such that they know that they can reuse the
+    retrieved file. The marker is only trusted if its token has been observed
+    while waiting, hence outdated markers from earlier retrievals are never
+    reused. The last process that consumes the marker (i.e. the one that sees
+    no further waiting processes upon release) removes it, such that no
+    markers are accumulated.
+
+    While held, the lock file is touched regularly. A lock whose file has not
+    been touched for stale_after seconds, or whose holder is a process on the
+    same host that does not exist anymore, is considered stale and broken.
+    """
+
+    def __init__(
+        self,
+        lock_dir: Path,
+        key: str,
+        stale_after: float = 300,
+        poll_interval: float = 0.5,
+    ) -> None:
+        name = hashlib.sha256(key.encode()).hexdigest()
+        self.path = lock_dir / f"{name}.lock"
+        self.done_path = lock_dir / f"{name}.done"
+        self.stale_after = stale_after
+        self.poll_interval = poll_interval
+        self.token = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex}"
+        self._stop_heartbeat: Optional[threading.Event] = None
+        self._consumed = False
+
+    async def acquire(self) -> bool:
+        """Wait for the lock and acquire it.
+
+        Returns True if another process successfully finished the retrieval
+        while this one was waiting.
+        """
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        observed: Set[str] = set()
+        while True:
+            try:
+                fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                holder = self._holder()
+                if holder is not None and holder not in observed:
+                    observed.add(holder)
+                    self._register_as_waiting()
+                if self._is_stale(holder):
+                    self._break(holder)
+                    continue
+                await asyncio.sleep(self.poll_interval)
+                continue
+            with os.fdopen(fd, "w") as f:
+                f.write(self.token)
+            break
+        self._start_heartbeat()
+        done = self._read(self.done_path)
+        self._consumed = done is not None and done in observed
+        if done is not None and not self._consumed:
+            # left behind by an earlier retrieval (e.g. of a waiting process
+            # that died), not useful to anybody anymore
+            self.done_path.unlink(missing_ok=True)
+        return self._consumed
+
+    def release(self, success: bool) -> None:
+        """Release the lock, marking the retrieval as successful if requested."""
+        if self._stop_heartbeat is not None:
+            self._stop_heartbeat.set()
+            self._stop_heartbeat = None
+        content = self._read(self.path)
+        if content is None or content.split("\n", 1)[0] != self.token:
+            # the lock has been broken in the meantime
+            return
+        waiting = "\n" in content
+        if not waiting:
+            self.done_path.unlink(missing_ok=True)
+        elif success and not self._consumed:
+            tmp = self.done_path.with_name(f"{self.done_path.name}.{uuid.uuid4().hex}")
+            tmp.write_text(self.token)
+            os.replace(tmp, self.done_path)
+        elif not success:
+            self.done_path.unlink(missing_ok=True)
+        # else: leave the consumed marker for the remaining waiting processes
+        self.path.unlink(missing_ok=True)
+
+    def _register_as_waiting(self) -> None:
+        # Do not create the file, it might just have been released.
+        try:
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND)
+        except FileNotFoundError:
+            return
+        with os.fdopen(fd, "w") as f:
+            stat = os.fstat(f.fileno())
+            f.write(f"\n{self.token}")
+            f.flush()
+            # Keep the modification time, only the heartbeat of the holder may
+            # prevent the lock from becoming stale. At worst, this reverts a
+            # concurrent heartbeat, which is followed by further ones in time.
+            os.utime(f.fileno(), ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+    def _start_heartbeat(self) -> None:
+        # Use a thread, since retrievals usually block the event loop.
+        stop = threading.Event()
+        interval = self.stale_after / 4
+
+        def heartbeat():
+            while not stop.wait(interval):
+                try:
+                    os.utime(self.path)
+                except OSError:
+                    return
+
+        threading.Thread(target=heartbeat, daemon=True).start()
+        self._stop_heartbeat = stop
+
+    def _is_stale(self, holder: Optional[str]) -> bool:
+        try:
+            if time.time() - self.path.stat().st_mtime > self.stale_after:
+                return True
+        except FileNotFoundError:
+            return False
+        if holder is None:
+            # the holder has not written its token yet
+            return False
+        try:
+            host, pid, _ = holder.split(":", 2)
+            pid = int(pid)
+        except ValueError:
+            # unexpected content, only broken once it is not touched anymore
+            return False
+        if host == socket.gethostname():
+            try:
+                os.kill(pid, 0)
+            except ProcessLookupError:
+                return True
+            except (PermissionError, OverflowError):
+                pass
+        return False
+
+    def _break(self, holder: Optional[str]) -> None:
+        # Only remove the lock if it is still held by the stale holder.
+        # This leaves a small race if two waiters break the same stale lock at
+        # the same time, which is accepted.
+        if self._holder() == holder:
+            self.path.unlink(missing_ok=True)
+
+    def _holder(self) -> Optional[str]:
+        # the first line of the lock file is the token of the holder, further
+        # lines are tokens of waiting processes
+        content = self._read(self.path)
+        if content is None:
+            return None
+        return content.split("\n", 1)[0] or None
+
+    @staticmethod
+    def _read(path: Path) -> Optional[str]:
+        try:
+            return path.read_text() or None
+        except FileNotFoundError:
+            return None
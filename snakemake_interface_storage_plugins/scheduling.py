@@ -0,0 +1,97 @@
+__author__ = "Christopher Tomkins-Tinch, Johannes Köster"
+__copyright__ = "Copyright 2023, Christopher Tomkins-Tinch, Johannes Köster"
+__email__ = "johannes.koester@uni-due.de"
+__license__ = "MIT"
+
+import asyncio
+import heapq
+import itertools
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+
+class PriorityScheduler:
+    """Grant a limited number of concurrent slots in order of priority.
+
+    Waiting operations are grouped into priority classes (higher values are
+    served first). Within a class, operations with a smaller size are served
+    first, and operations of equal size in the order of their arrival.
+    Operations without a size count as size 0, i.e. metadata operations
+    (which have no payload) are preferred over transfers.
+    In order to avoid starvation, a class that has been passed over
+    `fairness` times in a row is served next, regardless of its priority.
+    """
+
+    def __init__(self, max_concurrent: int, fairness: int = 4) -> None:
+        if max_concurrent < 1:
+            raise ValueError("max_concurrent has to be at least 1")
+        self.max_concurrent = max_concurrent
+        self.fairness = fairness
+        self._active = 0
+        self._counter = itertools.count()
+        self._waiting: Dict[int, List[Tuple[int, int, asyncio.Future]]] = {}
+        self._passed_over: Dict[int, int] = {}
+
+    @property
+    def active(self) -> int:
+        return self._active
+
+    @property
+    def waiting(self) -> int:
+        return sum(len(queue) for queue in self._waiting.values())
+
+    @asynccontextmanager
+    async def slot(
+        self, priority: int = 0, size: Optional[int] = None
+    ) -> AsyncIterator[None]:
+        """Wait for a slot, hold it while the context is active."""
+        if self._active < self.max_concurrent and not self._waiting:
+            self._active += 1
+        else:
+            future = asyncio.get_running_loop().create_future()
+            heapq.heappush(
+                self._waiting.setdefault(priority, []),
+                (size or 0, next(self._counter), future),
+            )
+            try:
+                await future
+            except asyncio.CancelledError:
+                if future.done() and not future.cancelled():
+                    # the slot has been granted in the meantime, pass it on
+                    self._release()
+                raise
+        try:
+            yield
+        finally:
+            self._release()
+
+    def _release(self) -> None:
+        self._active -= 1
+        self._grant()
+
+    def _select_class(self) -> int:
+        classes = sorted(self._waiting, reverse=True)
+        selected = classes[0]
+        for priority in classes[1:]:
+            if self._passed_over.get(priority, 0) >= self.fairness:
+                selected = priority
+                break
+        for priority in classes:
+            if priority == selected:
+                self._passed_over[priority] = 0
+            else:
+                self._passed_over[priority] = self._passed_over.get(priority, 0) + 1
+        return selected
+
+    def _grant(self) -> None:
+        while self._active < self.max_concurrent and self._waiting:
+            priority = self._select_class()
+            queue = self._waiting[priority]
+            _, _, future = heapq.heappop(queue)
+            if not queue:
+                del self._waiting[priority]
+                self._passed_over.pop(priority, None)
+            if future.cancelled():
+                continue
+            self._active += 1
+            future.set_result(None)
@@ -25,6 +25,77 @@ class StorageProviderSettingsBase(
         metadata={
             "help": "Maximum number of requests per second for this storage provider. "
             "If nothing is specified, the default implemented by the storage plugin is "
-            "used."
+            "used. The max_requests_per_second_* settings define separate limits for "
+            "individual kinds of requests."
+        },
+    )
+    max_concurrent_requests: Optional[int] = field(
+        default=None,
+        metadata={
+            "help": "Maximum number of concurrent requests for this storage provider. "
+            "Waiting requests are served in order of their priority. "
+            "If nothing is specified, the default implemented by the storage plugin "
+            "is used (usually unlimited). The max_concurrent_requests_* settings "
+            "define separate limits for individual kinds of requests."
+        },
+    )
+    max_requests_per_second_metadata: Optional[float] = field(
+        default=None,
+        metadata={"help": "Separate maximum number of metadata requests per second."},
+    )
+    max_requests_per_second_retrieve: Optional[float] = field(
+        default=None,
+        metadata={"help": "Separate maximum number of retrievals per second."},
+    )
+    max_requests_per_second_store: Optional[float] = field(
+        default=None,
+        metadata={"help": "Separate maximum number of stores and touches per second."},
+    )
+    max_requests_per_second_list: Optional[float] = field(
+        default=None,
+        metadata={"help": "Separate maximum number of listings per second."},
+    )
+    max_requests_per_second_remove: Optional[float] = field(
+        default=None,
+        metadata={"help": "Separate maximum number of removals per second."},
+    )
+    max_concurrent_requests_metadata: Optional[int] = field(
+        default=None,
+        metadata={"help": "Separate maximum number of concurrent metadata requests."},
+    )
+    max_concurrent_requests_retrieve: Optional[int] = field(
+        default=None,
+        metadata={"help": "Separate maximum number of concurrent retrievals."},
+    )
+    max_concurrent_requests_store: Optional[int] = field(
+        default=None,
+        metadata={"help": "Separate maximum number of concurrent stores and touches."},
+    )
+    max_concurrent_requests_list: Optional[int] = field(
+        default=None,
+        metadata={"help": "Separate maximum number of concurrent listings."},
+    )
+    max_concurrent_requests_remove: Optional[int] = field(
+        default=None,
+        metadata={"help": "Separate maximum number of concurrent removals."},
+    )
+    stat_cache_ttl: Optional[float] = field(
+        default=None,
+        metadata={
+            "help": "Number of seconds for which metadata (existence, size, "
+            "modification time, checksum) of a storage object is reused. "
+            "Only has an effect if the storage plugin supports fetching all metadata "
+            "with a single request. If nothing is specified, the default implemented "
+            "by the storage plugin is used."
+        },
+    )
+    verify_checksums: bool = field(
+        default=False,
+        metadata={
+            "help": "Verify retrieved and stored files by comparing a locally computed "
+            "checksum with the checksum reported by the storage. Only has an effect "
+            "for files and if the storage plugin provides checksums. Local checksums "
+            "are cached as long as size and modification time of a file do not "
+            "change."
         },
     )
@@ -5,55 +5,161 @@ __license__ = "MIT"
 
 import asyncio
 import copy
+import functools
+import hashlib
+import inspect
 import logging
 import os
 import shutil
+import time
+import uuid
 from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Iterable, Optional
+from typing import (
+    AsyncIterator,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Tuple,
+    TypeVar,
+)
 
-from humanfriendly import format_size, format_timespan
 from snakemake_interface_common.exceptions import WorkflowError
-from snakemake_interface_common.logging import get_logger
-from tenacity import after_log, retry, stop_after_attempt, wait_exponential
-from wrapt import ObjectProxy
 
+from snakemake_interface_storage_plugins.checksum import compute_checksum
 from snakemake_interface_storage_plugins.common import Operation, get_disk_free
-from snakemake_interface_storage_plugins.exceptions import FileOrDirectoryNotFoundError
-from snakemake_interface_storage_plugins.io import IOCacheStorageInterface
-from snakemake_interface_storage_plugins.storage_provider import StorageProviderBase
-
-retry_decorator = retry(
-    wait=wait_exponential(multiplier=3),
-    stop=stop_after_attempt(3),
-    after=after_log(get_logger(), logging.WARNING),
+from snakemake_interface_storage_plugins.compression import (
+    CODEC_METADATA_KEY,
+    UNCOMPRESSED_SIZE_METADATA_KEY,
+    compress_file,
+    decompress_file,
+)
+from snakemake_interface_storage_plugins.exceptions import (
+    CircuitOpenError,
+    FileOrDirectoryNotFoundError,
+)
+from snakemake_interface_storage_plugins.io import (
+    IOCacheStorageInterface,
+    compile_pattern,
+)
+from snakemake_interface_storage_plugins.locking import RetrievalLock
+from snakemake_interface_storage_plugins.storage_provider import (
+    RETRIEVAL_LOCK_DIR,
+    StorageProviderBase,
 )
 
+DEFAULT_LIST_PAGE_SIZE = 1000
+
+T = TypeVar("T")
+
+# Note: humanfriendly, tenacity and wrapt are imported on first use only.
+# This module is imported by every Snakemake worker job, hence its import time
+# directly adds to the startup time of each job.
+
 
-class StaticStorageObjectProxy(ObjectProxy):
-    """Proxy that implements static-ness for remote objects.
+@functools.lru_cache(maxsize=None)
+def _get_retry_decorator():
+    from snakemake_interface_common.logging import get_logger
+    from tenacity import after_log, retry, stop_after_attempt, wait_exponential
 
-    The constructor takes a real RemoteObject and returns a proxy that
-    behaves the same except for the exists() and mtime() methods.
+    return retry(
+        wait=wait_exponential(multiplier=3),
+        stop=stop_after_attempt(3),
+        after=after_log(get_logger(), logging.WARNING),
+    )
 
+
+def retry_decorator(func):
+    """Retry the decorated function up to three times with exponential backoff.
+
+    The underlying tenacity decorator is built upon the first call of the
+    decorated function, so that decorating methods at import time of a plugin
+    does not load tenacity and the snakemake logger.
     """
+    retrying = None
+
+    def get_retrying():
+        nonlocal retrying
+        if retrying is None:
+            retrying = _get_retry_decorator()(func)
+        return retrying
+
+    if inspect.iscoroutinefunction(func):
+
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            return await get_retrying()(*args, **kwargs)
+
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        return get_retrying()(*args, **kwargs)
+
+    return wrapper
+
+
+@functools.lru_cache(maxsize=None)
+def _get_static_storage_object_proxy_cls():
+    from wrapt import ObjectProxy
+
+    class StaticStorageObjectProxy(ObjectProxy):
+        """Proxy that implements static-ness for remote objects.
+
+        The constructor takes a real RemoteObject and returns a proxy that
+        behaves the same except for the exists() and mtime() methods.
+
+        """
+
+        def exists(self):
+            return True
+
+        def mtime(self) -> float:
+            return float("-inf")
+
+        def is_newer(self, time):
+            return False
+
+        def __copy__(self):
+            copied_wrapped = copy.copy(self.__wrapped__)
+            return type(self)(copied_wrapped)
 
-    def exists(self):
-        return True
+        def __deepcopy__(self, memo):
+            copied_wrapped = copy.deepcopy(self.__wrapped__, memo)
+            return type(self)(copied_wrapped)
 
-    def mtime(self) -> float:
-        return float("-inf")
+    StaticStorageObjectProxy.__module__ = __name__
+    StaticStorageObjectProxy.__qualname__ = "StaticStorageObjectProxy"
+    return StaticStorageObjectProxy
 
-    def is_newer(self, time):
-        return False
 
-    def __copy__(self):
-        copied_wrapped = copy.copy(self.__wrapped__)
-        return type(self)(copied_wrapped)
+def __getattr__(name: str):
+    # StaticStorageObjectProxy derives from wrapt.ObjectProxy, hence it is only
+    # created upon first access.
+    if name == "StaticStorageObjectProxy":
+        return _get_static_storage_object_proxy_cls()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
-    def __deepcopy__(self, memo):
-        copied_wrapped = copy.deepcopy(self.__wrapped__, memo)
-        return type(self)(copied_wrapped)
+
+@dataclass
+class StorageObjectStat:
+    """Metadata of a storage object as returned by StorageObjectRead.stat()."""
+
+    exists: bool
+    size: Optional[int] = None
+    mtime: Optional[float] = None
+    checksum: Optional[str] = None
+    # user defined metadata of the object (e.g. S3 object metadata)
+    metadata: Dict[str, str] = field(default_factory=dict)
+
+    def uncompressed_size(self) -> Optional[int]:
+        """Size of the object before transport compression (if compressed)."""
+        size = self.metadata.get(UNCOMPRESSED_SIZE_METADATA_KEY)
+        return int(size) if size is not None else None
 
 
 class StorageObjectBase(ABC):
@@ -61,8 +167,35 @@ class StorageObjectBase(ABC):
     different cloud storage providers. For example, there could be classes for
     interacting with Amazon AWS S3 and Google Cloud Storage, both derived from this
     common base class.
+
+    Workflows can contain millions of storage objects, hence the base classes
+    use __slots__. Derived classes can declare __slots__ as well in order to
+    avoid the creation of an instance __dict__.
     """
 
+    __slots__ = (
+        "_query",
+        "keep_local",
+        "retrieve",
+        "provider",
+        "_print_query",
+        "_local_path",
+        "_cache_key",
+        "_overwrite_local_path",
+        "_is_ondemand_eligible",
+        "_stat",
+        "_stat_time",
+        "_transport_metadata",
+        "__weakref__",
+    )
+
+    _print_query: Optional[str]
+    _local_path: Optional[Path]
+    _cache_key: Optional[str]
+    _stat: Optional["StorageObjectStat"]
+    _stat_time: float
+    _transport_metadata: Optional[Dict[str, str]]
+
     def __init__(
         self,
         query: str,
@@ -70,18 +203,43 @@ class StorageObjectBase(ABC):
         retrieve: bool,
         provider: StorageProviderBase,
     ):
-        self.query: str = query
         self.keep_local: bool = keep_local
         self.retrieve: bool = retrieve
         self.provider: StorageProviderBase = provider
-        self.print_query: str = self.provider.safe_print(self.query)
         self._overwrite_local_path: Optional[Path] = None
         self._is_ondemand_eligible: bool = False
+        self._stat = None
+        self._stat_time = 0.0
+        self._transport_metadata = None
+        self.query = query
         self.__post_init__()
 
     def __post_init__(self):  # noqa B027
         pass
 
+    @property
+    def query(self) -> str:
+        return self._query
+
+    @query.setter
+    def query(self, value: str):
+        self._query = value
+        # invalidate everything that is derived from the query
+        self._print_query = None
+        self._local_path = None
+        self._cache_key = None
+
+    @property
+    def print_query(self) -> str:
+        """The query with potentially sensitive information removed."""
+        if self._print_query is None:
+            self._print_query = self.provider.safe_print(self.query)
+        return self._print_query
+
+    @print_query.setter
+    def print_query(self, value: str):
+        self._print_query = value
+
     @property
     def is_ondemand_eligible(self) -> bool:
         return self._is_ondemand_eligible and not self.keep_local
@@ -94,6 +252,25 @@ class StorageObjectBase(ABC):
         """Set a custom local path for this storage object."""
         self._overwrite_local_path = path
 
+    @contextmanager
+    def _local_path_overwritten(self, path: Optional[Path]):
+        # Temporarily let local_path() point to the given path (if any).
+        # Only use this around synchronous calls, the object might be shared
+        # with other tasks.
+        if path is None:
+            yield
+            return
+        previous = self._overwrite_local_path
+        self._overwrite_local_path = path
+        try:
+            yield
+        finally:
+            self._overwrite_local_path = previous
+
+    def _transport_tmp_path(self, codec: str) -> Path:
+        local_path = self.local_path()
+        return local_path.with_name(f".{local_path.name}.{uuid.uuid4().hex}.{codec}")
+
     def is_valid_query(self) -> bool:
         """Return True is the query is valid for this storage provider."""
         return self.provider.is_valid_query(self.query)
@@ -102,15 +279,20 @@ class StorageObjectBase(ABC):
         """Return the local path that would represent the query."""
         if self._overwrite_local_path:
             return self._overwrite_local_path
-        else:
-            return self.provider.local_prefix / self.local_suffix()
+        if self._local_path is None:
+            self._local_path = self.provider.local_prefix / self.local_suffix()
+        return self._local_path
 
     def cache_key(self, local_suffix: Optional[str] = None) -> str:
         """Return a key for the cache."""
         assert self._overwrite_local_path is None, (
             "bug: no cache key applicable if local path is overwritten"
         )
-        return str(self.provider.local_prefix / (local_suffix or self.local_suffix()))
+        if local_suffix:
+            return str(self.provider.local_prefix / local_suffix)
+        if self._cache_key is None:
+            self._cache_key = str(self.provider.local_prefix / self.local_suffix())
+        return self._cache_key
 
     @abstractmethod
     def local_suffix(self) -> str:
@@ -120,11 +302,33 @@ class StorageObjectBase(ABC):
         # part and any optional parameters if that does not hamper the uniqueness.
         ...
 
+    def _invalidate_stat(self):
+        # the object has been modified, memoized metadata is outdated
+        self._stat = None
+
     def _rate_limiter(self, operation: Operation):
         return self.provider.rate_limiter(self.query, operation)
 
+    def _managed_operation(
+        self, operation: Operation, priority: int = 0, size: Optional[int] = None
+    ):
+        return self.provider.operation_slot(
+            self.query, operation, priority=priority, size=size
+        )
+
+    async def _hedged(self, operation: Operation, func: Callable[[], T]) -> T:
+        # Perform a metadata request, hedging it if the provider defines a
+        # hedging policy.
+        hedger = self.provider.request_hedger(self.query, operation)
+        if hedger is None:
+            async with self._managed_operation(operation):
+                return func()
+        return await hedger.call(func, lambda: self._managed_operation(operation))
+
 
 class StorageObjectRead(StorageObjectBase):
+    __slots__ = ()
+
     @abstractmethod
     async def inventory(self, cache: IOCacheStorageInterface):
         """From this file, try to find as much existence and modification date
@@ -189,59 +393,283 @@ class StorageObjectRead(StorageObjectBase):
         if not self.exists():
             raise FileOrDirectoryNotFoundError(self.print_query, self.local_path())
 
+    def stat(self) -> "StorageObjectStat":
+        """Return existence, size, modification time and checksum of the object
+        with a single request (e.g. a HEAD or stat call).
+
+        This is optional. If implemented, the managed_* methods for existence,
+        size, mtime and checksum share a single memoized result of this method,
+        instead of requesting each value separately. Fields that are not
+        available can be set to None; the corresponding methods are then used
+        as a fallback.
+        """
+        raise NotImplementedError()
+
+    async def _memoized_stat(self) -> Optional["StorageObjectStat"]:
+        # Return None if stat() is not implemented by the plugin.
+        if type(self).stat is StorageObjectRead.stat:
+            return None
+        now = time.monotonic()
+        if self._stat is None or now - self._stat_time > self.provider.stat_cache_ttl():
+            try:
+                self._stat = await self._hedged(Operation.EXISTS, self.stat)
+            except CircuitOpenError:
+                raise
+            except Exception as e:
+                raise WorkflowError(f"Failed to get metadata of {self.print_query}", e)
+            self._stat_time = now
+        return self._stat
+
+    async def _memoized_stat_of_existing(self) -> Optional["StorageObjectStat"]:
+        stat = await self._memoized_stat()
+        if stat is not None and not stat.exists:
+            raise FileOrDirectoryNotFoundError(self.local_path(), self.print_query)
+        return stat
+
     async def managed_size(self) -> int:
+        stat = await self._memoized_stat_of_existing()
+        if stat is not None:
+            if stat.uncompressed_size() is not None:
+                return stat.uncompressed_size()
+            if stat.size is not None:
+                return stat.size
         try:
-            async with self._rate_limiter(Operation.SIZE):
-                return self.size()
+            return await self._hedged(Operation.SIZE, self.size)
+        except CircuitOpenError:
+            raise
         except Exception as e:
             self._raise_object_not_found_if_not_exists()
             raise WorkflowError(f"Failed to get size of {self.print_query}", e)
 
     async def managed_checksum(self) -> Optional[str]:
+        stat = await self._memoized_stat_of_existing()
+        if stat is not None and stat.checksum is not None:
+            return stat.checksum
         try:
-            async with self._rate_limiter(Operation.SIZE):
+            async with self._managed_operation(Operation.SIZE):
                 return self.checksum()
+        except CircuitOpenError:
+            raise
         except Exception as e:
             self._raise_object_not_found_if_not_exists()
             raise WorkflowError(f"Failed to get checksum of {self.print_query}", e)
 
     async def managed_mtime(self) -> float:
+        stat = await self._memoized_stat_of_existing()
+        if stat is not None and stat.mtime is not None:
+            return stat.mtime
         try:
-            async with self._rate_limiter(Operation.MTIME):
-                return self.mtime()
+            return await self._hedged(Operation.MTIME, self.mtime)
+        except CircuitOpenError:
+            raise
         except Exception as e:
             self._raise_object_not_found_if_not_exists()
             raise WorkflowError(f"Failed to get mtime of {self.print_query}", e)
 
     async def managed_exists(self) -> bool:
+        stat = await self._memoized_stat()
+        if stat is not None:
+            return stat.exists
         try:
-            async with self._rate_limiter(Operation.EXISTS):
-                return self.exists()
+            return await self._hedged(Operation.EXISTS, self.exists)
+        except CircuitOpenError:
+            raise
         except Exception as e:
             raise WorkflowError(f"Failed to check existence of {self.print_query}", e)
 
-    async def managed_retrieve(self):
-        await self.wait_for_free_space()
-        try:
-            self.local_path().parent.mkdir(parents=True, exist_ok=True)
-            async with self._rate_limiter(Operation.RETRIEVE):
-                return self.retrieve_object()
-        except Exception as e:
-            # clean up potentially partially downloaded data
-            local_path = self.local_path()
-            if os.path.exists(local_path):
-                if os.path.isdir(local_path):
-                    shutil.rmtree(local_path)
-                else:
-                    os.remove(local_path)
+    async def managed_local_checksum(self, algorithm: str = "sha256") -> Optional[str]:
+        """Checksum of the local file in the form {algorithm}:{checksum}.
+
+        Returns None if the local path does not exist or is a directory.
+        Checksums are computed in a thread pool and cached as long as size
+        and modification time of the file do not change.
+        """
+        local_path = self.local_path()
+        if not local_path.is_file():
+            return None
+        return await self.provider.checksum_cache.checksum(local_path, algorithm)
+
+    async def verify_checksum(self):
+        """Compare the checksum of the local file with the checksum reported by the
+        storage, raising a WorkflowError in case of a mismatch.
+
+        Nothing is checked if the storage does not provide a checksum, the
+        checksum algorithm is not supported by hashlib, or the local path is a
+        directory.
+        """
+        await self._verify_checksum()
+
+    async def _verify_checksum(self, transport_path: Optional[Path] = None):
+        # The checksum of a temporary transport file (see _transport_tmp_path())
+        # is not cached, its sidecar would never be used again.
+        storage_checksum = await self.managed_checksum()
+        if storage_checksum is None:
+            return
+        algorithm = storage_checksum.split(":", 1)[0]
+        if algorithm not in hashlib.algorithms_available:
+            return
+        if transport_path is None:
+            local_checksum = await self.managed_local_checksum(algorithm)
+        else:
+            local_checksum = await asyncio.to_thread(
+                compute_checksum, transport_path, algorithm
+            )
+        if local_checksum is not None and local_checksum != storage_checksum:
             raise WorkflowError(
-                f"Failed to retrieve storage object from {self.print_query}", e
+                f"Checksum mismatch for {self.print_query}: "
+                f"{local_checksum} (local) != {storage_checksum} (storage)"
             )
 
+    async def managed_retrieve(self, priority: int = 0):
+        """Retrieve the object, see retrieve_object().
+
+        If the provider limits the number of concurrent requests, retrievals
+        with a higher priority (e.g. of jobs on the critical path) are served
+        first. If a retrieval of the same local path is already in progress
+        (e.g. because it has been prefetched), it is joined instead of starting
+        another one. A prefetch that still waits for a slot is cancelled
+        instead, such that the retrieval does not inherit its low priority.
+        """
+        key = str(self.local_path())
+        prefetched = self.provider._prefetched
+        if key in prefetched:
+            result = prefetched.pop(key)
+            if self.local_path().exists():
+                return result
+        task, joined = self._retrieval_task(priority)
+        try:
+            # shield the task, it may be shared with other callers
+            result = await asyncio.shield(task)
+            # a joined prefetch is consumed by this retrieval
+            self.provider._prefetched.pop(key, None)
+            return result
+        except WorkflowError:
+            if not joined:
+                raise
+        # The joined retrieval (e.g. a prefetch) failed, try again on our own.
+        # Errors of the failed attempt are reported by its own caller.
+        return await self._managed_retrieve(priority)
+
+    def _retrieval_task(
+        self, priority: int, semaphore: Optional[asyncio.Semaphore] = None
+    ) -> Tuple[asyncio.Task, bool]:
+        # Return the in-flight retrieval task for the local path of this object,
+        # or start a new one. The second value is True if an existing task is
+        # joined. A new task with a semaphore is a prefetch, which is cancelled
+        # and replaced by the next retrieval if it has not got a slot until then.
+        inflight = self.provider._inflight_retrievals
+        queued = self.provider._queued_prefetches
+        key = str(self.local_path())
+        task = inflight.get(key)
+        if task is not None and task.get_loop() is asyncio.get_running_loop():
+            if task not in queued:
+                return task, True
+            task.cancel()
+
+        def started():
+            queued.discard(asyncio.current_task())
+
+        async def retrieve():
+            if semaphore is None:
+                return await self._managed_retrieve(priority)
+            async with semaphore:
+                return await self._managed_retrieve(priority, on_start=started)
+
+        task = asyncio.ensure_future(retrieve())
+        inflight[key] = task
+        if semaphore is not None:
+            queued.add(task)
+
+        def unregister(task):
+            queued.discard(task)
+            if inflight.get(key) is task:
+                del inflight[key]
+
+        task.add_done_callback(unregister)
+        return task, False
+
+    async def _managed_retrieve(
+        self, priority: int = 0, on_start: Optional[Callable[[], None]] = None
+    ):
+        # Other processes (e.g. cluster jobs sharing the local prefix) might
+        # retrieve the same object. Only one of them downloads it, the others
+        # wait and reuse the result.
+        lock = RetrievalLock(
+            self.provider.local_prefix / RETRIEVAL_LOCK_DIR, str(self.local_path())
+        )
+        retrieved_by_other = await lock.acquire()
+        success = False
+        try:
+            if retrieved_by_other and self.local_path().exists():
+                success = True
+                return None
+            size = await self.wait_for_free_space()
+            try:
+                self.local_path().parent.mkdir(parents=True, exist_ok=True)
+                stat = await self._memoized_stat()
+                codec = stat.metadata.get(CODEC_METADATA_KEY) if stat else None
+                if codec is None:
+                    result = await self._retrieve(priority, size, on_start)
+                else:
+                    # the object has been stored with transport compression
+                    compressed = self._transport_tmp_path(codec)
+                    try:
+                        result = await self._retrieve(
+                            priority, size, on_start, transport_path=compressed
+                        )
+                        await asyncio.to_thread(
+                            decompress_file, compressed, self.local_path(), codec
+                        )
+                    finally:
+                        compressed.unlink(missing_ok=True)
+                success = True
+                return result
+            except Exception as e:
+                # clean up potentially partially downloaded data
+                # (safe, since no other process writes to it while we hold the lock)
+                local_path = self.local_path()
+                if os.path.exists(local_path):
+                    if os.path.isdir(local_path):
+                        shutil.rmtree(local_path)
+                    else:
+                        os.remove(local_path)
+                if isinstance(e, CircuitOpenError):
+                    raise
+                raise WorkflowError(
+                    f"Failed to retrieve storage object from {self.print_query}", e
+                )
+        finally:
+            lock.release(success)
+
+    async def _retrieve(
+        self,
+        priority: int,
+        size: int,
+        on_start: Optional[Callable[[], None]] = None,
+        transport_path: Optional[Path] = None,
+    ):
+        # If given, the object is retrieved into the transport path instead of
+        # the local path.
+        async with self._managed_operation(
+            Operation.RETRIEVE, priority=priority, size=size
+        ):
+            if on_start is not None:
+                on_start()
+            with self._local_path_overwritten(transport_path):
+                result = self.retrieve_object()
+        if self.provider.verify_checksums():
+            await self._verify_checksum(transport_path)
+        return result
+
     async def managed_local_footprint(self) -> int:
+        stat = await self._memoized_stat()
+        if stat is not None and stat.uncompressed_size() is not None:
+            return stat.uncompressed_size()
         try:
-            async with self._rate_limiter(Operation.SIZE):
+            async with self._managed_operation(Operation.SIZE):
                 return self.local_footprint()
+        except CircuitOpenError:
+            raise
         except Exception as e:
             raise WorkflowError(
                 f"Failed to get expected local footprint (i.e. size) "
@@ -249,8 +677,11 @@ class StorageObjectRead(StorageObjectBase):
                 e,
             )
 
-    async def wait_for_free_space(self):
-        """Wait for free space on the disk."""
+    async def wait_for_free_space(self) -> int:
+        """Wait for free space on the disk.
+
+        Returns the expected local footprint of the object.
+        """
         size = await self.managed_local_footprint()
         disk_free = get_disk_free(self.local_path())
 
@@ -266,6 +697,8 @@ class StorageObjectRead(StorageObjectBase):
 
             waited = 0
             while waited < wait_time and size > disk_free:
+                from humanfriendly import format_size, format_timespan
+
                 self.provider.logger.info(
                     f"Waiting {format_timespan(wait_time_step)} for enough free "
                     f"space to store {self.local_path()} "
@@ -276,6 +709,8 @@ class StorageObjectRead(StorageObjectBase):
                 disk_free = get_disk_free(self.local_path())
 
         if size > disk_free:
+            from humanfriendly import format_size, format_timespan
+
             if wait_time is not None:
                 raise WorkflowError(
                     f"Cannot store {self.local_path()} "
@@ -290,27 +725,105 @@ class StorageObjectRead(StorageObjectBase):
                     "no waiting since no wait time was configured with --wait-for-free-local-storage."
                 )
 
+        return size
+
 
 class StorageObjectWrite(StorageObjectBase):
+    __slots__ = ()
+
     @abstractmethod
     def store_object(self): ...
 
     @abstractmethod
     def remove(self): ...
 
+    def transport_metadata(self) -> Dict[str, str]:
+        """Metadata that store_object() has to attach to the stored object.
+
+        This is only non-empty if the provider enables transport compression
+        (see StorageProviderBase.transport_compression()). In that case, the
+        file under self.local_path() is compressed, and the metadata records the
+        codec and the uncompressed size. It has to be returned by stat() as part
+        of StorageObjectStat.metadata.
+        """
+        return self._transport_metadata or {}
+
+    async def _store(
+        self,
+        priority: int,
+        transport_path: Optional[Path] = None,
+        transport_metadata: Optional[Dict[str, str]] = None,
+    ):
+        # If given, the transport path is stored instead of the local path,
+        # with the given transport metadata.
+        local_path = transport_path or self.local_path()
+        size = local_path.stat().st_size if local_path.is_file() else None
+        async with self._managed_operation(
+            Operation.STORE, priority=priority, size=size
+        ):
+            self._transport_metadata = transport_metadata
+            try:
+                with self._local_path_overwritten(transport_path):
+                    self.store_object()
+            finally:
+                self._transport_metadata = None
+        self._invalidate_stat()
+        if self.provider.verify_checksums() and isinstance(self, StorageObjectRead):
+            await self._verify_checksum(transport_path)
+
     async def managed_remove(self):
         try:
-            async with self._rate_limiter(Operation.REMOVE):
+            async with self._managed_operation(Operation.REMOVE):
                 self.remove()
+        except CircuitOpenError:
+            raise
         except Exception as e:
             raise WorkflowError(
                 f"Failed to remove storage object {self.print_query}", e
             )
+        finally:
+            self._invalidate_stat()
 
-    async def managed_store(self):
+    async def managed_store(self, priority: int = 0):
+        """Store the object, see store_object().
+
+        If the provider limits the number of concurrent requests, stores
+        with a higher priority are served first.
+        """
+        self._invalidate_stat()
+        local_path = self.local_path()
+        is_file = local_path.is_file()
+        codec = self.provider.transport_compression() if is_file else None
+        if codec is not None and (
+            not isinstance(self, StorageObjectRead)
+            or type(self).stat is StorageObjectRead.stat
+        ):
+            # without stat(), the codec would be unknown upon retrieval
+            raise WorkflowError(
+                f"Cannot store {self.print_query} with transport compression: "
+                "the storage plugin has to implement stat() and return the "
+                "transport metadata."
+            )
         try:
-            async with self._rate_limiter(Operation.STORE):
-                self.store_object()
+            if codec is None:
+                await self._store(priority)
+            else:
+                compressed = self._transport_tmp_path(codec)
+                try:
+                    await asyncio.to_thread(
+                        compress_file, local_path, compressed, codec
+                    )
+                    metadata = {
+                        CODEC_METADATA_KEY: codec,
+                        UNCOMPRESSED_SIZE_METADATA_KEY: str(local_path.stat().st_size),
+                    }
+                    await self._store(
+                        priority, transport_path=compressed, transport_metadata=metadata
+                    )
+                finally:
+                    compressed.unlink(missing_ok=True)
+        except CircuitOpenError:
+            raise
         except Exception as e:
             raise WorkflowError(
                 f"Failed to store output in storage {self.print_query}", e
@@ -318,15 +831,96 @@ class StorageObjectWrite(StorageObjectBase):
 
 
 class StorageObjectGlob(StorageObjectBase):
+    __slots__ = ()
+
     @abstractmethod
     def list_candidate_matches(self) -> Iterable[str]:
-        """Return a list of candidate matches in the storage for the query."""
+        """Return an iterable of candidate matches in the storage for the query."""
         # This is used by glob_wildcards() to find matches for wildcards in the query.
         # The method has to return concretized queries without any remaining wildcards.
+        # Ideally, this is a generator that lazily requests further pages from the
+        # storage, such that the listing does not have to be kept in memory.
         ...
 
+    async def list_candidate_matches_paged(
+        self,
+        prefix: str,
+        delimiter: Optional[str] = None,
+        page_size: int = DEFAULT_LIST_PAGE_SIZE,
+    ) -> AsyncIterator[List[str]]:
+        """Yield pages of concretized queries in the storage that start with the
+        given prefix.
+
+        If a delimiter is given, only queries that do not contain the delimiter
+        after the prefix have to be returned (i.e. a non-recursive listing).
+        The page size is a hint for the number of items per page.
+        Storage plugins should overwrite this to push down prefix and delimiter
+        to the storage backend and use its native pagination.
+        By default, this filters and pages the result of list_candidate_matches().
+        """
+        page = []
+        for candidate in self.list_candidate_matches():
+            if not candidate.startswith(prefix):
+                continue
+            if delimiter is not None and delimiter in candidate[len(prefix) :]:
+                continue
+            page.append(candidate)
+            if len(page) >= page_size:
+                yield page
+                page = []
+        if page:
+            yield page
+
+    async def managed_list_candidate_matches(
+        self, page_size: int = DEFAULT_LIST_PAGE_SIZE
+    ) -> AsyncIterator[str]:
+        """Yield all concretized queries in the storage that match the query.
+
+        Pages are requested one by one (each taking a slot of the rate limiter),
+        and matched as they arrive, such that memory usage does not depend on the
+        size of the listing.
+        """
+        pattern = compile_pattern(self.query)
+        pages = self.list_candidate_matches_paged(
+            pattern.complete_constant_prefix,
+            delimiter=pattern.delimiter,
+            page_size=page_size,
+        )
+        if not inspect.isasyncgen(pages):
+            if inspect.iscoroutine(pages):
+                # avoid a "never awaited" warning
+                pages.close()
+            raise WorkflowError(
+                f"Failed to list candidate matches of {self.print_query}: "
+                "list_candidate_matches_paged() of the storage plugin has to be an "
+                "async generator (i.e. yield pages instead of returning them)."
+            )
+        try:
+            while True:
+                try:
+                    async with self._managed_operation(Operation.LIST):
+                        try:
+                            page = await pages.__anext__()
+                        except StopAsyncIteration:
+                            page = None
+                except CircuitOpenError:
+                    raise
+                except Exception as e:
+                    raise WorkflowError(
+                        f"Failed to list candidate matches of {self.print_query}", e
+                    )
+                if page is None:
+                    break
+                for candidate in page:
+                    if pattern.match(candidate) is not None:
+                        yield candidate
+        finally:
+            await pages.aclose()
+
 
 class StorageObjectTouch(StorageObjectBase):
+    __slots__ = ()
+
     @abstractmethod
     def touch(self):
         """Touch the object."""
@@ -334,7 +928,11 @@ class StorageObjectTouch(StorageObjectBase):
 
     async def managed_touch(self):
         try:
-            async with self._rate_limiter(Operation.TOUCH):
+            async with self._managed_operation(Operation.TOUCH):
                 self.touch()
+        except CircuitOpenError:
+            raise
         except Exception as e:
             raise WorkflowError(f"Failed to touch storage object {self.print_query}", e)
+        finally:
+            self._invalidate_stat()
@@ -4,21 +4,58 @@ __email__ = "johannes.koester@uni-due.de"
 __license__ = "MIT"
 
 
+import asyncio
+from collections import defaultdict
 from contextlib import asynccontextmanager
 from dataclasses import dataclass
 from enum import Enum
 from fractions import Fraction
+from functools import lru_cache
 from logging import Logger
 from pathlib import Path
 import sys
+import weakref
 from abc import ABC, abstractmethod
-from typing import Any, List, Optional
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Sequence,
+    Set,
+)
 
-from throttler import Throttler
 from snakemake_interface_common.exceptions import WorkflowError
-from snakemake_interface_storage_plugins.common import Operation
+from snakemake_interface_storage_plugins.checksum import ChecksumCache
+from snakemake_interface_storage_plugins.circuit_breaker import (
+    CircuitBreaker,
+    CircuitBreakerPolicy,
+)
+from snakemake_interface_storage_plugins.common import Operation, get_disk_free
+from snakemake_interface_storage_plugins.exceptions import (
+    CircuitOpenError,
+    FileOrDirectoryNotFoundError,
+)
+from snakemake_interface_storage_plugins.hedging import HedgingPolicy, RequestHedger
+from snakemake_interface_storage_plugins.scheduling import PriorityScheduler
 from snakemake_interface_storage_plugins.settings import StorageProviderSettingsBase
 
+if TYPE_CHECKING:
+    from snakemake_interface_storage_plugins.storage_object import StorageObjectBase
+
+# directory (relative to the local prefix) for caching checksums of local files
+CHECKSUM_CACHE_DIR = ".snakemake-checksums"
+# directory (relative to the local prefix) for retrieval lock files
+RETRIEVAL_LOCK_DIR = ".snakemake-locks"
+# default priority of prefetched retrievals, lower than that of regular ones
+PREFETCH_PRIORITY = -1
+# maximum number of memoized query validations and postprocessings
+QUERY_MEMO_SIZE = 100000
+
 
 @dataclass
 class StorageQueryValidationResult:
@@ -79,20 +116,63 @@ class StorageProviderBase(ABC):
         self.retrieve = retrieve
         self.is_default = is_default
         self._rate_limiters = dict()
+        self._schedulers: Dict[Any, PriorityScheduler] = dict()
+        self._circuit_breakers: Dict[Any, CircuitBreaker] = dict()
+        self._request_hedgers: Dict[Any, RequestHedger] = dict()
+        # local path -> task of a retrieval that is currently in progress
+        self._inflight_retrievals: Dict[str, asyncio.Task] = dict()
+        # prefetch tasks that still wait for a slot
+        self._queued_prefetches: Set[asyncio.Task] = set()
+        # local path -> result of a finished prefetch that is not consumed yet
+        self._prefetched: Dict[str, Any] = dict()
+        self._interned_objects: weakref.WeakValueDictionary = (
+            weakref.WeakValueDictionary()
+        )
+        self._checksum_cache: Optional[ChecksumCache] = None
+        self._validate_query_memoized = lru_cache(maxsize=QUERY_MEMO_SIZE)(
+            self.is_valid_query
+        )
+        self._postprocess_query_memoized = lru_cache(maxsize=QUERY_MEMO_SIZE)(
+            self.postprocess_query
+        )
         self.__post_init__()
 
     def __post_init__(self):  # noqa B027
         pass
 
+    def _operation_class_setting(self, name: str, operation: Operation) -> Any:
+        # Return the per operation class override of the given setting, if any.
+        if self.settings is None:
+            return None
+        return getattr(self.settings, f"{name}_{operation.operation_class.value}", None)
+
     def rate_limiter(self, query: str, operation: Operation):
+        """Return the rate limiter for the given query and operation.
+
+        Rate limiters are shared per rate limiter key, unless a per operation
+        class rate (e.g. max_requests_per_second_store) is configured, which
+        yields a separate rate limiter for that operation class.
+        """
         if not self.use_rate_limiter():
             return self._noop_context()
         else:
             key = self.rate_limiter_key(query, operation)
+            max_requests_per_second = self._operation_class_setting(
+                "max_requests_per_second", operation
+            )
+            if max_requests_per_second is not None:
+                key = (key, operation.operation_class)
+            else:
+                max_requests_per_second = (
+                    self.settings.max_requests_per_second
+                    if self.settings is not None
+                    else None
+                ) or self.default_max_requests_per_second()
             if key not in self._rate_limiters:
+                from throttler import Throttler
+
                 max_status_checks_frac = Fraction(
-                    self.settings.max_requests_per_second
-                    or self.default_max_requests_per_second()
+                    max_requests_per_second
                 ).limit_denominator()
                 self._rate_limiters[key] = Throttler(
                     rate_limit=max_status_checks_frac.numerator,
@@ -100,6 +180,163 @@ class StorageProviderBase(ABC):
                 )
             return self._rate_limiters[key]
 
+    def default_max_concurrent_requests(self) -> Optional[int]:
+        """Return the default maximum number of concurrent requests per rate limiter
+        key for this storage provider, or None if it shall not be limited."""
+        return None
+
+    def scheduler(
+        self, query: str, operation: Operation
+    ) -> Optional[PriorityScheduler]:
+        """Return the priority scheduler for the given query and operation, or None
+        if the number of concurrent requests is not limited.
+
+        As for rate limiters, a per operation class limit (e.g.
+        max_concurrent_requests_store) yields a separate scheduler.
+        """
+        key = self.rate_limiter_key(query, operation)
+        max_concurrent = self._operation_class_setting(
+            "max_concurrent_requests", operation
+        )
+        if max_concurrent is not None:
+            key = (key, operation.operation_class)
+        else:
+            max_concurrent = (
+                self.settings.max_concurrent_requests
+                if self.settings is not None
+                else None
+            ) or self.default_max_concurrent_requests()
+            if max_concurrent is None:
+                return None
+        if key not in self._schedulers:
+            self._schedulers[key] = PriorityScheduler(max_concurrent)
+        return self._schedulers[key]
+
+    def circuit_breaker_policy(self) -> Optional[CircuitBreakerPolicy]:
+        """Return the circuit breaker policy for this storage provider, or None
+        (the default) if no circuit breaker shall be used.
+
+        Circuit breakers are kept per rate limiter key.
+        """
+        return None
+
+    def circuit_breaker(
+        self, query: str, operation: Operation
+    ) -> Optional[CircuitBreaker]:
+        policy = self.circuit_breaker_policy()
+        if policy is None:
+            return None
+        key = self.rate_limiter_key(query, operation)
+        if key not in self._circuit_breakers:
+            self._circuit_breakers[key] = CircuitBreaker(key, policy, self.logger)
+        return self._circuit_breakers[key]
+
+    def is_endpoint_failure(self, exception: Exception) -> bool:
+        """Return True if the given exception, raised while performing a request,
+        indicates that the storage endpoint is failing (e.g. a connection error,
+        a timeout or a server error). Only those count towards the circuit
+        breaker.
+
+        By default, missing implementations, local file system errors (OSErrors
+        that refer to a file name) and lookup, value, type and attribute errors
+        (e.g. "not found" errors of in-memory indexes or plugin bugs) do not
+        count. Plugins can overwrite this in order to classify their own
+        exception types, e.g. to exclude "not found" or "access denied" errors.
+        """
+        if isinstance(exception, (ConnectionError, TimeoutError)):
+            return True
+        if isinstance(exception, OSError):
+            return exception.filename is None
+        return not isinstance(
+            exception,
+            (NotImplementedError, LookupError, ValueError, TypeError, AttributeError),
+        )
+
+    def transport_compression(self) -> Optional[str]:
+        """Return the codec ("gzip" or "zstd") for compressing files when storing
+        them, or None (the default) if files shall be transferred as they are.
+
+        Only enable this if the storage object persists transport_metadata() in
+        store_object() and returns it via StorageObjectStat.metadata in stat().
+        Objects stored with compression are decompressed upon retrieval, and
+        managed_size() and managed_local_footprint() report the uncompressed size.
+        """
+        return None
+
+    def request_hedging_policy(self) -> Optional[HedgingPolicy]:
+        """Return the hedging policy for metadata requests (exists, mtime, size)
+        of this storage provider, or None (the default) if requests shall not be
+        hedged.
+
+        With hedging, a duplicate of a request is issued if it takes longer than
+        a percentile of recent latencies, and the first result is used.
+        Hedged requests are executed in threads, hence the corresponding
+        methods of the storage object have to be thread-safe.
+        """
+        return None
+
+    def request_hedger(
+        self, query: str, operation: Operation
+    ) -> Optional[RequestHedger]:
+        policy = self.request_hedging_policy()
+        if policy is None:
+            return None
+        key = (self.rate_limiter_key(query, operation), operation)
+        if key not in self._request_hedgers:
+            self._request_hedgers[key] = RequestHedger(policy)
+        return self._request_hedgers[key]
+
+    @asynccontextmanager
+    async def operation_slot(
+        self,
+        query: str,
+        operation: Operation,
+        priority: int = 0,
+        size: Optional[int] = None,
+    ):
+        """Wait until the given operation may be performed and hold the slot while
+        the context is active.
+
+        If the number of concurrent requests is limited, waiting operations are
+        served in order of their priority (higher first) and, within the same
+        priority, their size (smaller first), see PriorityScheduler.
+        Afterwards, the rate limiter is applied.
+        If a circuit breaker policy is defined, operations on an endpoint that
+        failed repeatedly raise a CircuitOpenError right away.
+        """
+        breaker = self.circuit_breaker(query, operation)
+        if breaker is not None:
+            # fail fast before waiting for a slot
+            breaker.before_call()
+        try:
+            scheduler = self.scheduler(query, operation)
+            if scheduler is None:
+                async with self.rate_limiter(query, operation):
+                    yield
+            else:
+                async with scheduler.slot(priority=priority, size=size):
+                    async with self.rate_limiter(query, operation):
+                        yield
+        except FileOrDirectoryNotFoundError:
+            # the endpoint is responsive
+            if breaker is not None:
+                breaker.record_success()
+            raise
+        except Exception as e:
+            if breaker is not None:
+                if self.is_endpoint_failure(e):
+                    breaker.record_failure()
+                else:
+                    breaker.record_cancel()
+            raise
+        except BaseException:
+            if breaker is not None:
+                breaker.record_cancel()
+            raise
+        else:
+            if breaker is not None:
+                breaker.record_success()
+
     @asynccontextmanager
     async def _noop_context(self):
         yield
@@ -131,12 +368,37 @@ class StorageProviderBase(ABC):
         """Return False if no rate limiting is needed for this provider."""
         ...
 
+    def default_stat_cache_ttl(self) -> float:
+        """Return the default number of seconds for which the result of
+        StorageObjectRead.stat() is reused."""
+        return 10.0
+
+    def stat_cache_ttl(self) -> float:
+        if self.settings is not None and self.settings.stat_cache_ttl is not None:
+            return self.settings.stat_cache_ttl
+        return self.default_stat_cache_ttl()
+
+    def verify_checksums(self) -> bool:
+        """Return True if retrieved and stored files shall be verified via
+        their checksums."""
+        return self.settings is not None and self.settings.verify_checksums
+
+    @property
+    def checksum_cache(self) -> ChecksumCache:
+        """Sidecar cache for checksums of local files."""
+        if self._checksum_cache is None:
+            self._checksum_cache = ChecksumCache(
+                self.local_prefix / CHECKSUM_CACHE_DIR, logger=self.logger
+            )
+        return self._checksum_cache
+
     @classmethod
     @abstractmethod
     def is_valid_query(cls, query: str) -> StorageQueryValidationResult:
         """Validate the given query for this storage provider.
 
         This should also work when the query contains wildcards (e.g. "{sample}").
+        The result must only depend on the query, since it is memoized.
         """
         ...
 
@@ -145,9 +407,31 @@ class StorageProviderBase(ABC):
 
         This can e.g. be modified in a subclass to add a protocol or global settings,
         or normalize the scheme if multiple ones are possible.
+        The result must only depend on the query, since it is memoized.
         """
         return query
 
+    def validate_queries(
+        self, queries: Iterable[str]
+    ) -> List[StorageQueryValidationResult]:
+        """Validate the given queries, see is_valid_query().
+
+        Results are memoized (up to QUERY_MEMO_SIZE queries), hence
+        is_valid_query() has to be deterministic.
+        """
+        return [self._validate_query_memoized(query) for query in queries]
+
+    def postprocess_queries(self, queries: Iterable[str]) -> List[str]:
+        """Postprocess the given queries, see postprocess_query().
+
+        Results are memoized (up to QUERY_MEMO_SIZE queries), hence
+        postprocess_query() has to be deterministic. In contrast, object() does
+        not memoize, such that creating many storage objects does not fill the
+        memo. Callers that create objects for all queries of a large workflow
+        can postprocess them here first.
+        """
+        return [self._postprocess_query_memoized(query) for query in queries]
+
     def safe_print(self, query: str) -> str:
         """Process the query to remove potentially sensitive information when printing.
 
@@ -156,6 +440,206 @@ class StorageProviderBase(ABC):
         """
         return query
 
+    def remove_many(
+        self, objects: List["StorageObjectBase"]
+    ) -> Optional[Dict[str, Exception]]:
+        """Remove the given storage objects with a single request (e.g. a batch
+        delete).
+
+        Return a dict mapping the queries of objects that could not be removed to
+        the corresponding exception (None or an empty dict if all succeeded).
+        This is optional. If not overwritten, managed_remove_many() falls back to
+        removing each object separately.
+        """
+        raise NotImplementedError()
+
+    def touch_many(
+        self, objects: List["StorageObjectBase"]
+    ) -> Optional[Dict[str, Exception]]:
+        """Touch the given storage objects with a single request.
+
+        Return a dict mapping the queries of objects that could not be touched to
+        the corresponding exception (None or an empty dict if all succeeded).
+        This is optional. If not overwritten, managed_touch_many() falls back to
+        touching each object separately.
+        """
+        raise NotImplementedError()
+
+    def max_bulk_size(self) -> int:
+        """Return the maximum number of objects that can be passed to
+        remove_many() and touch_many() at once."""
+        return 1000
+
+    async def managed_remove_many(
+        self, objects: Sequence["StorageObjectBase"], max_concurrency: int = 8
+    ) -> Dict[str, Optional[WorkflowError]]:
+        """Remove the given storage objects in batches.
+
+        Returns a dict mapping each query to None if removal succeeded, or to
+        a WorkflowError otherwise.
+        """
+        return await self._managed_bulk(
+            objects,
+            Operation.REMOVE,
+            self.remove_many
+            if type(self).remove_many is not StorageProviderBase.remove_many
+            else None,
+            lambda obj: obj.managed_remove(),
+            "remove",
+            max_concurrency,
+        )
+
+    async def managed_touch_many(
+        self, objects: Sequence["StorageObjectBase"], max_concurrency: int = 8
+    ) -> Dict[str, Optional[WorkflowError]]:
+        """Touch the given storage objects in batches.
+
+        Returns a dict mapping each query to None if touching succeeded, or to
+        a WorkflowError otherwise.
+        """
+        return await self._managed_bulk(
+            objects,
+            Operation.TOUCH,
+            self.touch_many
+            if type(self).touch_many is not StorageProviderBase.touch_many
+            else None,
+            lambda obj: obj.managed_touch(),
+            "touch",
+            max_concurrency,
+        )
+
+    async def _managed_bulk(
+        self,
+        objects: Sequence["StorageObjectBase"],
+        operation: Operation,
+        bulk_func: Optional[
+            Callable[[List["StorageObjectBase"]], Optional[Dict[str, Exception]]]
+        ],
+        single_func: Callable[["StorageObjectBase"], Awaitable[Any]],
+        action: str,
+        max_concurrency: int,
+    ) -> Dict[str, Optional[WorkflowError]]:
+        results: Dict[str, Optional[WorkflowError]] = {}
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def single(obj):
+            try:
+                await single_func(obj)
+                results[obj.query] = None
+            except WorkflowError as e:
+                results[obj.query] = e
+            finally:
+                obj._invalidate_stat()
+
+        if bulk_func is None:
+            # No bulk support by this provider. This is checked before taking
+            # any slot, such that no request is wasted on it.
+            async def limited_single(obj):
+                async with semaphore:
+                    await single(obj)
+
+            await asyncio.gather(*(limited_single(obj) for obj in objects))
+            return results
+
+        # Chunks may only contain objects that share a rate limiter,
+        # since each chunk is a single request.
+        groups = defaultdict(list)
+        for obj in objects:
+            groups[self.rate_limiter_key(obj.query, operation)].append(obj)
+        size = self.max_bulk_size()
+        chunks = [
+            group[i : i + size]
+            for group in groups.values()
+            for i in range(0, len(group), size)
+        ]
+
+        async def process(chunk):
+            async with semaphore:
+                try:
+                    async with self.operation_slot(chunk[0].query, operation):
+                        errors = await asyncio.to_thread(bulk_func, chunk) or {}
+                except NotImplementedError:
+                    # no bulk support for this chunk
+                    await asyncio.gather(*(single(obj) for obj in chunk))
+                    return
+                except Exception as e:
+                    errors = {obj.query: e for obj in chunk}
+            for obj in chunk:
+                # also if failed, the object might have been modified partially
+                obj._invalidate_stat()
+                error = errors.get(obj.query)
+                results[obj.query] = (
+                    None
+                    if error is None
+                    else error
+                    if isinstance(error, CircuitOpenError)
+                    else WorkflowError(
+                        f"Failed to {action} storage object {obj.print_query}", error
+                    )
+                )
+
+        await asyncio.gather(*(process(chunk) for chunk in chunks))
+        return results
+
+    async def prefetch(
+        self,
+        objects: Iterable["StorageObjectBase"],
+        budget_bytes: int,
+        max_concurrent: int = 4,
+        priority: int = PREFETCH_PRIORITY,
+    ) -> List[asyncio.Task]:
+        """Start retrieving the given objects (e.g. inputs of jobs that will run
+        soon) in the background.
+
+        Objects are considered in the given order and skipped if they are already
+        present locally, already being retrieved, or if they would exceed the
+        budget (in bytes) or the currently free local disk space.
+        At most max_concurrent prefetches run at the same time, and they are
+        scheduled with the given (low) priority.
+        A later managed_retrieve() of a prefetched object joins the
+        prefetch instead of starting another download. If the prefetch still
+        waits for a slot at that point, it is cancelled and the object is
+        retrieved with the priority of managed_retrieve() instead.
+        Returns the started tasks. A failed prefetch is only logged, the
+        subsequent managed_retrieve() will try again.
+        """
+        # forget finished prefetches whose local files have been removed
+        # in the meantime
+        for key in [key for key in self._prefetched if not Path(key).exists()]:
+            del self._prefetched[key]
+        semaphore = asyncio.Semaphore(max_concurrent)
+        tasks = []
+        used = 0
+        for obj in objects:
+            local_path = obj.local_path()
+            if local_path.exists() or str(local_path) in self._inflight_retrievals:
+                continue
+            try:
+                size = await obj.managed_local_footprint()
+            except WorkflowError as e:
+                self.logger.debug(f"Skipping prefetch of {obj.print_query}: {e}")
+                continue
+            if used + size > budget_bytes or size > get_disk_free(local_path):
+                continue
+            used += size
+            task, _ = obj._retrieval_task(priority, semaphore=semaphore)
+            task.add_done_callback(self._prefetch_done(obj, str(local_path)))
+            tasks.append(task)
+        return tasks
+
+    def _prefetch_done(self, obj: "StorageObjectBase", key: str):
+        def callback(task: asyncio.Task):
+            if task.cancelled():
+                return
+            if task.exception() is not None:
+                self.logger.debug(
+                    f"Prefetch of {obj.print_query} failed: {task.exception()}"
+                )
+            else:
+                self._prefetched[key] = task.result()
+
+        return callback
+
     @property
     def is_read_write(self) -> bool:
         from snakemake_interface_storage_plugins.storage_object import (
@@ -175,7 +659,17 @@ class StorageProviderBase(ABC):
         keep_local: Optional[bool] = None,
         retrieve: Optional[bool] = None,
         static: bool = False,
+        intern: bool = False,
     ):
+        """Return a storage object for the given query.
+
+        If intern is True, storage objects are deduplicated: as long as a storage
+        object for the same (postprocessed) query and flags that has been created
+        with intern=True is alive, it is returned instead of creating a new one.
+        The caller has to ensure that interned objects are not modified afterwards
+        (e.g. via set_local_path() or by assigning a new query), since the
+        modification would be visible to all other holders of the object.
+        """
         from snakemake_interface_storage_plugins.storage_object import (
             StaticStorageObjectProxy,
         )
@@ -188,6 +682,12 @@ class StorageProviderBase(ABC):
         if retrieve is None:
             retrieve = self.retrieve
 
+        if intern:
+            key = (query, keep_local, retrieve, static)
+            storage_object = self._interned_objects.get(key)
+            if storage_object is not None:
+                return storage_object
+
         storage_object = self.get_storage_object_cls()(
             query=query,
             keep_local=keep_local,
@@ -198,4 +698,7 @@ class StorageProviderBase(ABC):
         if static:
             storage_object = StaticStorageObjectProxy(storage_object)
 
+        if intern:
+            self._interned_objects[key] = storage_object
+
         return storage_object
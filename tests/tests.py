@@ -3,21 +3,154 @@ __copyright__ = "Copyright 2023, Christopher Tomkins-Tinch, Johannes Köster"
 __email__ = "johannes.koester@uni-due.de"
 __license__ = "MIT"
 
-from typing import List, Optional, Type
-from snakemake_interface_storage_plugins.io import get_constant_prefix
+import asyncio
+import contextlib
+import hashlib
+import logging
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Iterable, List, Optional, Type
+
+import pytest
+
+from snakemake_interface_storage_plugins.caching import CachingStorageProvider
+from snakemake_interface_storage_plugins.circuit_breaker import (
+    CircuitBreakerPolicy,
+    CircuitState,
+)
+from snakemake_interface_storage_plugins.checksum import ChecksumCache, compute_checksum
+from snakemake_interface_storage_plugins.common import Operation
+from snakemake_interface_storage_plugins.compression import (
+    CODEC_METADATA_KEY,
+    compress_file,
+    decompress_file,
+)
+from snakemake_interface_storage_plugins.hedging import HedgingPolicy, RequestHedger
+from snakemake_interface_storage_plugins.io import (
+    IOCacheStorageInterface,
+    PatternIndex,
+    compile_pattern,
+    get_constant_prefix,
+)
+from snakemake_interface_storage_plugins.locking import RetrievalLock
 from snakemake_interface_storage_plugins.registry import StoragePluginRegistry
+from snakemake_interface_storage_plugins.scheduling import PriorityScheduler
 from snakemake_interface_common.plugin_registry.tests import TestRegistryBase
 from snakemake_interface_common.plugin_registry.plugin import PluginBase, SettingsBase
 from snakemake_interface_common.plugin_registry import PluginRegistryBase
+from snakemake_interface_common.exceptions import WorkflowError
 from snakemake_interface_storage_plugins.settings import StorageProviderSettingsBase
 
-from snakemake_interface_storage_plugins.storage_provider import StorageProviderBase
+from snakemake_interface_storage_plugins.exceptions import (
+    CircuitOpenError,
+    FileOrDirectoryNotFoundError,
+)
+from snakemake_interface_storage_plugins.storage_object import (
+    StorageObjectGlob,
+    StorageObjectRead,
+    StorageObjectStat,
+    StorageObjectTouch,
+    StorageObjectWrite,
+)
+from snakemake_interface_storage_plugins.storage_provider import (
+    CHECKSUM_CACHE_DIR,
+    ExampleQuery,
+    QueryType,
+    StorageProviderBase,
+    StorageQueryValidationResult,
+)
 
 from snakemake_storage_plugin_http import StorageProvider, StorageProviderSettings
 
 from snakemake_interface_storage_plugins.tests import TestStorageBase
 
 
+class DummyStorageProvider(StorageProviderBase):
+    """In-memory storage provider used for testing the base classes."""
+
+    def __post_init__(self):
+        # query -> (content, mtime)
+        self.objects = dict()
+
+    @classmethod
+    def example_queries(cls) -> List[ExampleQuery]:
+        return [ExampleQuery("dummy://foo.txt", "A dummy file.", QueryType.ANY)]
+
+    def rate_limiter_key(self, query: str, operation: Operation) -> Any:
+        return "dummy"
+
+    def default_max_requests_per_second(self) -> float:
+        return 1000.0
+
+    def use_rate_limiter(self) -> bool:
+        return False
+
+    @classmethod
+    def is_valid_query(cls, query: str) -> StorageQueryValidationResult:
+        return StorageQueryValidationResult(
+            query=query, valid=query.startswith("dummy://")
+        )
+
+    @classmethod
+    def get_storage_object_cls(cls):
+        return DummyStorageObject
+
+
+class DummyStorageObject(StorageObjectRead, StorageObjectWrite, StorageObjectGlob):
+    __slots__ = ()
+
+    async def inventory(self, cache: IOCacheStorageInterface):
+        pass
+
+    def get_inventory_parent(self) -> Optional[str]:
+        return None
+
+    def local_suffix(self) -> str:
+        return self.query[len("dummy://") :]
+
+    def cleanup(self):
+        pass
+
+    def exists(self) -> bool:
+        return self.query in self.provider.objects
+
+    def mtime(self) -> float:
+        return self.provider.objects[self.query][1]
+
+    def size(self) -> int:
+        return len(self.provider.objects[self.query][0])
+
+    def retrieve_object(self):
+        self.local_path().write_bytes(self.provider.objects[self.query][0])
+
+    def store_object(self):
+        self.provider.objects[self.query] = (
+            self.local_path().read_bytes(),
+            time.time(),
+        )
+
+    def remove(self):
+        del self.provider.objects[self.query]
+
+    def list_candidate_matches(self) -> Iterable[str]:
+        yield from self.provider.objects
+
+
+def get_dummy_provider(
+    tmp_path, provider_cls: Type[DummyStorageProvider] = DummyStorageProvider, **kwargs
+) -> DummyStorageProvider:
+    return provider_cls(
+        local_prefix=Path(tmp_path) / "local_prefix",
+        logger=logging.getLogger(__name__),
+        **kwargs,
+    )
+
+
 class TestRegistry(TestRegistryBase):
     __test__ = True
 
@@ -87,3 +220,1127 @@ def test_get_constant_prefix():
         )
         == ""
     )
+    # prefixes are computed without compiling (and caching) the pattern
+    compile_pattern.cache_clear()
+    get_constant_prefix("foo/{uncached}/baz")
+    assert compile_pattern.cache_info().currsize == 0
+
+
+# Upper bound for the time needed to import the storage object module.
+# This is imported in every Snakemake worker job, hence it has to stay fast.
+IMPORT_TIME_BUDGET = 0.5
+
+
+def test_import_time():
+    code = """
+import sys, time
+start = time.perf_counter()
+import snakemake_interface_storage_plugins.storage_object
+print(time.perf_counter() - start)
+print(",".join(
+    mod for mod in ("humanfriendly", "tenacity", "wrapt", "throttler")
+    if mod in sys.modules
+))
+"""
+    res = subprocess.run(
+        [sys.executable, "-c", code], check=True, capture_output=True, text=True
+    )
+    elapsed, loaded = res.stdout.splitlines()
+    assert not loaded, f"heavy modules loaded at import time: {loaded}"
+    assert float(elapsed) < IMPORT_TIME_BUDGET
+
+
+# Upper bound for the memory footprint of a single storage object in bytes.
+STORAGE_OBJECT_MEMORY_BUDGET = 256
+
+
+def test_storage_object_memory(tmp_path):
+    provider = get_dummy_provider(tmp_path)
+    n = 10000
+    queries = [f"dummy://sample{i}.txt" for i in range(n)]
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    objs = [provider.object(query) for query in queries]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    assert not hasattr(objs[0], "__dict__")
+    # the list itself takes 8 bytes per item
+    assert (after - before) / n - 8 < STORAGE_OBJECT_MEMORY_BUDGET
+
+
+def test_storage_object_memoization(tmp_path):
+    provider = get_dummy_provider(tmp_path)
+    obj = provider.object("dummy://foo/bar.txt")
+    assert obj.print_query == "dummy://foo/bar.txt"
+    assert obj.local_path() is obj.local_path()
+    assert obj.local_path() == provider.local_prefix / "foo/bar.txt"
+    assert obj.cache_key() == str(provider.local_prefix / "foo/bar.txt")
+    assert obj.cache_key("baz") == str(provider.local_prefix / "baz")
+
+    # changing the query invalidates the memoized values
+    obj.query = "dummy://foo/baz.txt"
+    assert obj.print_query == "dummy://foo/baz.txt"
+    assert obj.local_path() == provider.local_prefix / "foo/baz.txt"
+    assert obj.cache_key() == str(provider.local_prefix / "foo/baz.txt")
+
+    obj.set_local_path(Path("custom.txt"))
+    assert obj.local_path() == Path("custom.txt")
+
+
+def test_storage_object_interning(tmp_path):
+    provider = get_dummy_provider(tmp_path)
+    obj = provider.object("dummy://foo.txt", intern=True)
+    assert provider.object("dummy://foo.txt", intern=True) is obj
+    # not interned objects are always fresh
+    assert provider.object("dummy://foo.txt") is not obj
+    # flags are part of the key
+    assert provider.object("dummy://foo.txt", keep_local=True, intern=True) is not obj
+    static = provider.object("dummy://foo.txt", static=True, intern=True)
+    assert static is not obj
+    assert provider.object("dummy://foo.txt", static=True, intern=True) is static
+    assert static.exists()
+
+    # the table does not keep objects alive
+    del obj, static
+    assert len(provider._interned_objects) == 0
+
+
+def test_compile_pattern():
+    compiled = compile_pattern("s3://bucket/{sample}/{sample}.{ext,txt|csv}")
+    assert compile_pattern("s3://bucket/{sample}/{sample}.{ext,txt|csv}") is compiled
+    assert compiled.constant_prefix == "s3://bucket/"
+    assert compiled.wildcard_names == ("sample", "ext")
+    assert compiled.segments == (
+        "s3:",
+        "",
+        "bucket",
+        "{sample}",
+        "{sample}.{ext,txt|csv}",
+    )
+    assert compiled.match("s3://bucket/a/a.txt") == {"sample": "a", "ext": "txt"}
+    assert compiled.match("s3://bucket/a/b.txt") is None
+    assert compiled.match("s3://bucket/a/a.tsv") is None
+    assert compile_pattern("foo/{a.b}.txt").match("foo/x.txt") == {"a.b": "x"}
+    lazy = compile_pattern("foo/{lazy}.txt")
+    assert lazy._regex is None
+    assert lazy.match("foo/x.txt") == {"lazy": "x"}
+    assert lazy._regex is not None
+    assert compile_pattern("foo/bar.txt").match("foo/bar.txt") == {}
+    # the character range covers the slash, hence no delimiter may be used
+    compiled = compile_pattern("s3://b/{x,[!-~]+}.txt")
+    assert compiled.delimiter is None
+    assert compiled.match("s3://b/a/b.txt") == {"x": "a/b"}
+
+
+@pytest.mark.parametrize(
+    "constraint,delimiter",
+    [
+        ("[a-z0-9_-]+", "/"),
+        (r"\d+\.\w+", "/"),
+        ("txt|csv", "/"),
+        ("[--z]+", None),
+        ("[^_]+", None),
+        (".+", None),
+    ],
+)
+def test_compile_pattern_delimiter(constraint, delimiter):
+    # the delimiter may only be pushed down if the wildcard cannot match a slash
+    compiled = compile_pattern(f"s3://b/{{x,{constraint}}}.txt")
+    assert compiled.delimiter == delimiter
+    if delimiter is None:
+        assert compiled.match("s3://b/a/b.txt") is not None
+
+
+def test_pattern_index():
+    index = PatternIndex(
+        [
+            "s3://bucket/a/{sample}.txt",
+            "s3://bucket/a/{sample}.csv",
+            "s3://bucket/b{x}/{y}.txt",
+            "s3://other/{sample}.txt",
+        ]
+    )
+    assert index.listing_prefixes() == ["s3://bucket/", "s3://other/"]
+    matches = index.match_all(
+        [
+            "s3://bucket/a/1.txt",
+            "s3://bucket/a/2.csv",
+            "s3://bucket/b1/3.txt",
+            "s3://bucket/c/4.txt",
+            "s3://other/5.txt",
+        ]
+    )
+    assert matches == {
+        "s3://bucket/a/{sample}.txt": [("s3://bucket/a/1.txt", {"sample": "1"})],
+        "s3://bucket/a/{sample}.csv": [("s3://bucket/a/2.csv", {"sample": "2"})],
+        "s3://bucket/b{x}/{y}.txt": [("s3://bucket/b1/3.txt", {"x": "1", "y": "3"})],
+        "s3://other/{sample}.txt": [("s3://other/5.txt", {"sample": "5"})],
+    }
+
+
+def test_managed_list_candidate_matches(tmp_path):
+    provider = get_dummy_provider(tmp_path)
+    for query in [
+        "dummy://a/1.txt",
+        "dummy://a/2.txt",
+        "dummy://a/3.csv",
+        "dummy://a/b/4.txt",
+        "dummy://c/5.txt",
+    ]:
+        provider.objects[query] = (b"", 0.0)
+
+    async def collect(obj, **kwargs):
+        return [item async for item in obj.managed_list_candidate_matches(**kwargs)]
+
+    obj = provider.object("dummy://a/{sample}.txt")
+    assert asyncio.run(collect(obj, page_size=2)) == [
+        "dummy://a/1.txt",
+        "dummy://a/2.txt",
+        "dummy://a/b/4.txt",
+    ]
+    obj = provider.object("dummy://a/{sample,[0-9]+}.txt")
+    assert compile_pattern(obj.query).delimiter == "/"
+    assert asyncio.run(collect(obj)) == ["dummy://a/1.txt", "dummy://a/2.txt"]
+
+    async def paged(obj):
+        return [
+            page
+            async for page in obj.list_candidate_matches_paged(
+                "dummy://a/", delimiter="/", page_size=2
+            )
+        ]
+
+    assert asyncio.run(paged(obj)) == [
+        ["dummy://a/1.txt", "dummy://a/2.txt"],
+        ["dummy://a/3.csv"],
+    ]
+
+
+def test_managed_list_candidate_matches_is_lazy(tmp_path):
+    provider = get_dummy_provider(tmp_path)
+    provider.listed = 0
+
+    class HugeListingStorageObject(DummyStorageObject):
+        def list_candidate_matches(self) -> Iterable[str]:
+            for i in range(10000000):
+                self.provider.listed += 1
+                yield f"dummy://{i}.txt"
+
+    obj = HugeListingStorageObject(
+        query="dummy://{sample}.txt", keep_local=False, retrieve=True, provider=provider
+    )
+
+    async def first():
+        async for item in obj.managed_list_candidate_matches(page_size=10):
+            return item
+
+    assert asyncio.run(first()) == "dummy://0.txt"
+    assert provider.listed <= 10
+
+
+def test_managed_list_candidate_matches_requires_async_generator(tmp_path):
+    provider = get_dummy_provider(tmp_path)
+
+    class ReturningStorageObject(DummyStorageObject):
+        async def list_candidate_matches_paged(
+            self, prefix, delimiter=None, page_size=1000
+        ):
+            return [["dummy://a.txt"]]
+
+    obj = ReturningStorageObject(
+        query="dummy://{sample}.txt", keep_local=False, retrieve=True, provider=provider
+    )
+
+    async def collect():
+        return [item async for item in obj.managed_list_candidate_matches()]
+
+    with pytest.raises(WorkflowError, match="async generator"):
+        asyncio.run(collect())
+
+
+def test_managed_remove_many(tmp_path):
+    class BulkStorageProvider(DummyStorageProvider):
+        def __post_init__(self):
+            super().__post_init__()
+            self.requests = 0
+
+        def max_bulk_size(self) -> int:
+            return 3
+
+        def remove_many(self, objects):
+            self.requests += 1
+            errors = {}
+            for obj in objects:
+                if obj.query in self.objects:
+                    del self.objects[obj.query]
+                else:
+                    errors[obj.query] = KeyError(obj.query)
+            return errors
+
+    for provider_cls, expected_requests in (
+        (BulkStorageProvider, 4),
+        # fallback to remove() of each object
+        (DummyStorageProvider, None),
+    ):
+        provider = get_dummy_provider(tmp_path, provider_cls)
+        objs = [provider.object(f"dummy://{i}.txt") for i in range(10)]
+        for obj in objs[:-1]:
+            provider.objects[obj.query] = (b"", 0.0)
+
+        results = asyncio.run(provider.managed_remove_many(objs))
+
+        assert not provider.objects
+        assert [results[obj.query] is None for obj in objs] == [True] * 9 + [False]
+        assert isinstance(results["dummy://9.txt"], WorkflowError)
+        if expected_requests is not None:
+            assert provider.requests == expected_requests
+
+
+def test_managed_metadata_uses_single_stat(tmp_path):
+    provider = get_dummy_provider(tmp_path)
+    provider.stat_calls = 0
+
+    class StatStorageObject(DummyStorageObject):
+        def stat(self) -> StorageObjectStat:
+            self.provider.stat_calls += 1
+            if not self.exists():
+                return StorageObjectStat(exists=False)
+            content, mtime = self.provider.objects[self.query]
+            return StorageObjectStat(
+                exists=True, size=len(content), mtime=mtime, checksum="sha256:0"
+            )
+
+        def size(self) -> int:
+            raise AssertionError("size() should not be called")
+
+        def mtime(self) -> float:
+            raise AssertionError("mtime() should not be called")
+
+    obj = StatStorageObject(
+        query="dummy://foo.txt", keep_local=False, retrieve=True, provider=provider
+    )
+
+    async def metadata():
+        return (
+            await obj.managed_exists(),
+            await obj.managed_size(),
+            await obj.managed_mtime(),
+            await obj.managed_checksum(),
+        )
+
+    provider.objects[obj.query] = (b"test", 1.0)
+    assert asyncio.run(metadata()) == (True, 4, 1.0, "sha256:0")
+    assert provider.stat_calls == 1
+
+    # modifications invalidate the memoized metadata
+    asyncio.run(obj.managed_remove())
+    assert not asyncio.run(obj.managed_exists())
+    assert provider.stat_calls == 2
+    with pytest.raises(FileOrDirectoryNotFoundError):
+        asyncio.run(obj.managed_size())
+
+
+def test_managed_remove_many_invalidates_stat(tmp_path):
+    class StatStorageObject(DummyStorageObject):
+        def stat(self) -> StorageObjectStat:
+            return StorageObjectStat(exists=self.exists())
+
+    class BulkStorageProvider(DummyStorageProvider):
+        def remove_many(self, objects):
+            for obj in objects:
+                del self.objects[obj.query]
+
+    # bulk requests and fallback to remove() of each object
+    for provider_cls in (BulkStorageProvider, DummyStorageProvider):
+        provider = get_dummy_provider(tmp_path, provider_cls)
+        objs = [
+            StatStorageObject(
+                query=f"dummy://{i}.txt",
+                keep_local=False,
+                retrieve=True,
+                provider=provider,
+            )
+            for i in range(3)
+        ]
+        for obj in objs:
+            provider.objects[obj.query] = (b"", 0.0)
+
+        async def exist():
+            return [await obj.managed_exists() for obj in objs]
+
+        assert asyncio.run(exist()) == [True] * 3
+        asyncio.run(provider.managed_remove_many(objs))
+        assert asyncio.run(exist()) == [False] * 3
+
+
+def test_write_only_storage_object(tmp_path):
+    provider = get_dummy_provider(tmp_path)
+
+    class WriteOnlyStorageObject(StorageObjectWrite, StorageObjectTouch):
+        __slots__ = ()
+
+        def local_suffix(self) -> str:
+            return self.query[len("dummy://") :]
+
+        def store_object(self):
+            self.provider.objects[self.query] = (self.local_path().read_bytes(), 0.0)
+
+        def remove(self):
+            del self.provider.objects[self.query]
+
+        def touch(self):
+            content, _ = self.provider.objects[self.query]
+            self.provider.objects[self.query] = (content, 1.0)
+
+    obj = WriteOnlyStorageObject(
+        query="dummy://foo.txt", keep_local=False, retrieve=True, provider=provider
+    )
+    obj.local_path().parent.mkdir(parents=True, exist_ok=True)
+    obj.local_path().write_bytes(b"test")
+    asyncio.run(obj.managed_store())
+    asyncio.run(obj.managed_touch())
+    assert provider.objects[obj.query] == (b"test", 1.0)
+    asyncio.run(obj.managed_remove())
+    assert not provider.objects
+
+
+def test_stat_cache_ttl(tmp_path):
+    provider = get_dummy_provider(tmp_path)
+    assert provider.stat_cache_ttl() == provider.default_stat_cache_ttl()
+    provider = get_dummy_provider(
+        tmp_path, settings=StorageProviderSettingsBase(stat_cache_ttl=0.5)
+    )
+    assert provider.stat_cache_ttl() == 0.5
+
+
+def test_checksum_cache(tmp_path):
+    path = tmp_path / "data.txt"
+    path.write_bytes(b"x" * 1000)
+    expected = f"sha256:{hashlib.sha256(b'x' * 1000).hexdigest()}"
+    assert compute_checksum(path, chunk_size=7) == expected
+    assert compute_checksum(tmp_path / "data.txt", "md5").startswith("md5:")
+    empty = tmp_path / "empty.txt"
+    empty.touch()
+    assert compute_checksum(empty) == f"sha256:{hashlib.sha256().hexdigest()}"
+
+    cache = ChecksumCache(tmp_path / "cache")
+    assert cache.get(path, "sha256") is None
+    assert asyncio.run(cache.checksum(path)) == expected
+    assert cache.get(path, "sha256") == expected
+
+    # a modified file is hashed again
+    path.write_bytes(b"y" * 1000)
+    os.utime(path, ns=(0, 0))
+    assert cache.get(path, "sha256") is None
+    assert asyncio.run(cache.checksum(path)) == (
+        f"sha256:{hashlib.sha256(b'y' * 1000).hexdigest()}"
+    )
+
+
+def test_checksum_cache_concurrent_set(tmp_path):
+    path = tmp_path / "data.txt"
+    path.write_bytes(b"x" * 1000)
+    checksum = compute_checksum(path)
+    stat = path.stat()
+    cache = ChecksumCache(tmp_path / "cache")
+
+    def set_many():
+        for _ in range(100):
+            cache.set(path, checksum, stat)
+
+    # threads of the same process must not share temporary files
+    with ThreadPoolExecutor(8) as executor:
+        for future in [executor.submit(set_many) for _ in range(8)]:
+            future.result()
+    assert cache.get(path, "sha256") == checksum
+    assert [p.suffix for p in (tmp_path / "cache").iterdir()] == [".json"]
+
+    # failing to write the sidecar is not an error
+    (tmp_path / "not_a_dir").touch()
+    ChecksumCache(tmp_path / "not_a_dir").set(path, checksum, stat)
+
+
+def test_verify_checksums(tmp_path):
+    class ChecksumStorageObject(DummyStorageObject):
+        def checksum(self) -> Optional[str]:
+            content = self.provider.objects[self.query][0]
+            return f"sha256:{hashlib.sha256(content).hexdigest()}"
+
+        def retrieve_object(self):
+            super().retrieve_object()
+            if self.provider.corrupt:
+                self.local_path().write_text("corrupted")
+
+    provider = get_dummy_provider(
+        tmp_path, settings=StorageProviderSettingsBase(verify_checksums=True)
+    )
+    obj = ChecksumStorageObject(
+        query="dummy://foo.txt", keep_local=False, retrieve=True, provider=provider
+    )
+    provider.corrupt = False
+    obj.local_path().write_text("test")
+    asyncio.run(obj.managed_store())
+    obj.local_path().unlink()
+    asyncio.run(obj.managed_retrieve())
+    assert obj.local_path().read_text() == "test"
+
+    # simulate a corrupted download
+    provider.corrupt = True
+    obj.local_path().unlink()
+    with pytest.raises(WorkflowError, match="Checksum mismatch"):
+        asyncio.run(obj.managed_retrieve())
+    assert not obj.local_path().exists()
+
+
+def test_priority_scheduler():
+    async def run(requests, fairness=4):
+        scheduler = PriorityScheduler(max_concurrent=1, fairness=fairness)
+        order = []
+
+        async def request(name, priority, size=None):
+            async with scheduler.slot(priority=priority, size=size):
+                order.append(name)
+                await asyncio.sleep(0)
+
+        # occupy the only slot until all requests are queued
+        async with scheduler.slot():
+            tasks = [asyncio.create_task(request(*req)) for req in requests]
+            await asyncio.sleep(0)
+            assert scheduler.waiting == len(requests)
+        await asyncio.gather(*tasks)
+        assert scheduler.active == 0
+        return order
+
+    # higher priority first, within a priority smaller objects first
+    assert asyncio.run(
+        run([("a", 0, 10), ("b", 1, 100), ("c", 1, 1), ("d", 0, None)])
+    ) == ["c", "b", "d", "a"]
+    # lower priorities are not starved
+    assert asyncio.run(
+        run([("low", 0)] + [(f"high{i}", 1) for i in range(4)], fairness=2)
+    ) == ["high0", "high1", "low", "high2", "high3"]
+
+
+def test_priority_scheduler_cancel():
+    async def run():
+        scheduler = PriorityScheduler(max_concurrent=1)
+        async with scheduler.slot():
+            task = asyncio.create_task(scheduler.slot().__aenter__())
+            await asyncio.sleep(0)
+            task.cancel()
+            await asyncio.sleep(0)
+        async with scheduler.slot():
+            assert scheduler.active == 1
+        assert scheduler.active == 0
+
+    asyncio.run(run())
+
+
+def test_operation_slot(tmp_path):
+    provider = get_dummy_provider(tmp_path)
+    assert provider.scheduler("dummy://foo.txt", Operation.RETRIEVE) is None
+    provider = get_dummy_provider(
+        tmp_path, settings=StorageProviderSettingsBase(max_concurrent_requests=2)
+    )
+    scheduler = provider.scheduler("dummy://foo.txt", Operation.RETRIEVE)
+    assert scheduler.max_concurrent == 2
+    assert provider.scheduler("dummy://bar.txt", Operation.STORE) is scheduler
+
+    obj = provider.object("dummy://foo.txt")
+    obj.local_path().write_text("test")
+    asyncio.run(obj.managed_store(priority=1))
+    obj.local_path().unlink()
+    asyncio.run(obj.managed_retrieve(priority=1))
+    assert obj.local_path().read_text() == "test"
+    assert scheduler.active == 0
+
+
+def test_prefetch(tmp_path):
+    provider = get_dummy_provider(tmp_path)
+    provider.retrievals = 0
+
+    class CountingStorageObject(DummyStorageObject):
+        def retrieve_object(self):
+            self.provider.retrievals += 1
+            super().retrieve_object()
+
+    objs = [
+        CountingStorageObject(
+            query=f"dummy://{i}.txt", keep_local=False, retrieve=True, provider=provider
+        )
+        for i in range(3)
+    ]
+    for obj in objs:
+        provider.objects[obj.query] = (b"x" * 10, 0.0)
+
+    async def run():
+        # the budget only covers the first two objects
+        tasks = await provider.prefetch(objs, budget_bytes=25)
+        assert len(tasks) == 2
+        # replaces the prefetch that has not started yet
+        await objs[0].managed_retrieve()
+        assert tasks[0].cancelled()
+        await asyncio.gather(tasks[1])
+        assert provider.retrievals == 2
+        # uses the finished prefetch
+        await objs[1].managed_retrieve()
+        assert provider.retrievals == 2
+        # not prefetched
+        await objs[2].managed_retrieve()
+        assert provider.retrievals == 3
+        # a prefetch is only used once
+        await objs[0].managed_retrieve()
+        await objs[1].managed_retrieve()
+        assert provider.retrievals == 5
+
+    asyncio.run(run())
+    assert all(obj.local_path().exists() for obj in objs)
+    # finished prefetches of removed files are forgotten
+    objs[0].local_path().unlink()
+    provider._prefetched[str(objs[0].local_path())] = None
+    asyncio.run(provider.prefetch([], budget_bytes=0))
+    assert not provider._prefetched
+
+
+def test_prefetch_priority(tmp_path):
+    provider = get_dummy_provider(
+        tmp_path, settings=StorageProviderSettingsBase(verify_checksums=True)
+    )
+    provider.order = []
+
+    class SlowStorageObject(DummyStorageObject):
+        def retrieve_object(self):
+            self.provider.order.append(self.query)
+            super().retrieve_object()
+
+        async def managed_checksum(self):
+            # keep the retrieval running after the transfer
+            await asyncio.sleep(0.05)
+            return None
+
+    objs = [
+        SlowStorageObject(
+            query=f"dummy://{i}.txt", keep_local=False, retrieve=True, provider=provider
+        )
+        for i in range(10)
+    ]
+    for obj in objs:
+        provider.objects[obj.query] = (b"x", 0.0)
+
+    async def run():
+        tasks = await provider.prefetch(objs, budget_bytes=100, max_concurrent=1)
+        await asyncio.sleep(0.01)
+        assert provider.order == [objs[0].query]
+        # joins the running prefetch
+        await objs[0].managed_retrieve(priority=100)
+        assert provider.order.count(objs[0].query) == 1
+        # does not wait for the queued prefetches
+        await objs[-1].managed_retrieve(priority=100)
+        assert provider.order.index(objs[-1].query) <= 2
+        assert tasks[-1].cancelled()
+        await asyncio.gather(*tasks[:-1])
+        assert sorted(provider.order) == sorted(obj.query for obj in objs)
+
+    asyncio.run(run())
+
+
+def test_retrieval_lock(tmp_path):
+    async def run(success):
+        # two locks with the same key simulate two processes
+        first = RetrievalLock(tmp_path, "key", poll_interval=0.01)
+        second = RetrievalLock(tmp_path, "key", poll_interval=0.01)
+        assert not await first.acquire()
+        waiting = asyncio.create_task(second.acquire())
+        await asyncio.sleep(0.05)
+        assert not waiting.done()
+        first.release(success=success)
+        retrieved_by_other = await waiting
+        second.release(success=False)
+        assert not second.path.exists()
+        return retrieved_by_other
+
+    assert asyncio.run(run(success=True))
+    assert not asyncio.run(run(success=False))
+    # the last consumer removes the marker
+    assert list(tmp_path.iterdir()) == []
+
+    # a marker of an earlier retrieval is not reused without waiting
+    lock = RetrievalLock(tmp_path, "key")
+    lock.done_path.write_text("otherhost:1:abc")
+    assert not asyncio.run(lock.acquire())
+    assert not lock.done_path.exists()
+    lock.release(success=True)
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_retrieval_lock_multiple_waiters(tmp_path):
+    async def run():
+        locks = [RetrievalLock(tmp_path, "key", poll_interval=0.01) for _ in range(3)]
+        assert not await locks[0].acquire()
+        waiting = [asyncio.create_task(lock.acquire()) for lock in locks[1:]]
+        await asyncio.sleep(0.05)
+        locks[0].release(success=True)
+        assert locks[0].done_path.exists()
+        # waiters acquire one after the other, the marker is kept for the second
+        done, _ = await asyncio.wait(waiting, return_when=asyncio.FIRST_COMPLETED)
+        first = waiting.index(done.pop())
+        assert waiting[first].result()
+        locks[1 + first].release(success=True)
+        assert await waiting[1 - first]
+        locks[2 - first].release(success=True)
+
+    asyncio.run(run())
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_retrieval_lock_stale(tmp_path):
+    lock = RetrievalLock(tmp_path, "key", stale_after=10, poll_interval=0.01)
+    # not touched for too long
+    lock.path.write_text("otherhost:1:abc")
+    os.utime(lock.path, (0, 0))
+    assert not asyncio.run(asyncio.wait_for(lock.acquire(), timeout=1))
+    lock.release(success=False)
+
+    # holder process on this host does not exist anymore
+    proc = subprocess.Popen([sys.executable, "-c", "pass"])
+    proc.wait()
+    lock.path.write_text(f"{lock.token.split(':')[0]}:{proc.pid}:abc")
+    assert not asyncio.run(asyncio.wait_for(lock.acquire(), timeout=1))
+    lock.release(success=False)
+    assert not lock.path.exists()
+
+    # unexpected content is only broken once it is not touched anymore
+    lock.path.write_text("garbage")
+    assert not lock._is_stale(lock._holder())
+    os.utime(lock.path, (0, 0))
+    assert not asyncio.run(asyncio.wait_for(lock.acquire(), timeout=1))
+    lock.release(success=False)
+
+
+def test_circuit_breaker(tmp_path):
+    class FlakyStorageProvider(DummyStorageProvider):
+        def __post_init__(self):
+            super().__post_init__()
+            self.down = True
+            self.calls = 0
+
+        def circuit_breaker_policy(self) -> Optional[CircuitBreakerPolicy]:
+            return CircuitBreakerPolicy(failure_threshold=3, reset_timeout=0.1)
+
+    class FlakyStorageObject(DummyStorageObject):
+        def exists(self) -> bool:
+            self.provider.calls += 1
+            if self.provider.down:
+                raise ConnectionError("endpoint down")
+            return super().exists()
+
+    provider = get_dummy_provider(tmp_path, FlakyStorageProvider)
+    obj = FlakyStorageObject(
+        query="dummy://foo.txt", keep_local=False, retrieve=True, provider=provider
+    )
+    breaker = provider.circuit_breaker(obj.query, Operation.EXISTS)
+
+    for _ in range(3):
+        with pytest.raises(WorkflowError):
+            asyncio.run(obj.managed_exists())
+    assert breaker.state == CircuitState.OPEN
+
+    # fail fast without calling the backend, consistently for all accessors
+    for accessor in (
+        obj.managed_exists,
+        obj.managed_size,
+        obj.managed_mtime,
+        obj.managed_checksum,
+        obj.managed_local_footprint,
+        obj.managed_remove,
+    ):
+        with pytest.raises(CircuitOpenError, match="failing fast"):
+            asyncio.run(accessor())
+    assert provider.calls == 3
+
+    # a failing probe opens the circuit again
+    time.sleep(0.1)
+    with pytest.raises(WorkflowError):
+        asyncio.run(obj.managed_exists())
+    assert provider.calls == 4
+    assert breaker.state == CircuitState.OPEN
+
+    # a successful probe closes it
+    time.sleep(0.1)
+    provider.down = False
+    assert not asyncio.run(obj.managed_exists())
+    assert breaker.state == CircuitState.CLOSED
+
+
+def test_bulk_fallback_with_circuit_breaker(tmp_path):
+    class GuardedStorageProvider(DummyStorageProvider):
+        def circuit_breaker_policy(self) -> Optional[CircuitBreakerPolicy]:
+            return CircuitBreakerPolicy(failure_threshold=3)
+
+        def max_bulk_size(self) -> int:
+            return 2
+
+    provider = get_dummy_provider(tmp_path, GuardedStorageProvider)
+    objs = [provider.object(f"dummy://{i}.txt") for i in range(10)]
+    for obj in objs:
+        provider.objects[obj.query] = (b"", 0.0)
+
+    results = asyncio.run(provider.managed_remove_many(objs))
+
+    assert results == {obj.query: None for obj in objs}
+    assert not provider.objects
+    breaker = provider.circuit_breaker(objs[0].query, Operation.REMOVE)
+    assert breaker.state == CircuitState.CLOSED
+
+
+def test_is_endpoint_failure(tmp_path):
+    provider = get_dummy_provider(tmp_path)
+    assert provider.is_endpoint_failure(ConnectionError("reset"))
+    assert provider.is_endpoint_failure(TimeoutError())
+    assert provider.is_endpoint_failure(OSError("server error"))
+    assert provider.is_endpoint_failure(RuntimeError("server error"))
+    assert not provider.is_endpoint_failure(
+        PermissionError(13, "Permission denied", "/local/file")
+    )
+    assert not provider.is_endpoint_failure(KeyError("dummy://foo.txt"))
+    assert not provider.is_endpoint_failure(NotImplementedError())
+
+
+def test_request_hedging():
+    hedger = RequestHedger(HedgingPolicy(min_samples=5, max_hedge_ratio=0.1))
+    slots = 0
+
+    def slot():
+        nonlocal slots
+        slots += 1
+        return contextlib.nullcontext()
+
+    calls = 0
+
+    def request():
+        nonlocal calls
+        calls += 1
+        if calls == 6:
+            # straggler
+            time.sleep(0.6)
+            return "slow"
+        return "fast"
+
+    async def run():
+        for _ in range(5):
+            assert await hedger.call(request, slot) == "fast"
+        assert hedger.threshold() is not None
+        start = time.monotonic()
+        assert await hedger.call(request, slot) == "fast"
+        assert time.monotonic() - start < 0.3
+        # the hedge ratio is exhausted
+        assert not hedger._may_hedge()
+
+    asyncio.run(run())
+    assert hedger.hedged == 1
+    # the hedge takes its own slot
+    assert slots == 7
+
+
+def test_managed_exists_hedged(tmp_path):
+    class HedgingStorageProvider(DummyStorageProvider):
+        def request_hedging_policy(self) -> Optional[HedgingPolicy]:
+            return HedgingPolicy(min_samples=1)
+
+    provider = get_dummy_provider(tmp_path, HedgingStorageProvider)
+    obj = provider.object("dummy://foo.txt")
+    provider.objects[obj.query] = (b"test", 1.0)
+    assert asyncio.run(obj.managed_exists())
+    assert asyncio.run(obj.managed_size()) == 4
+    assert provider.request_hedger(obj.query, Operation.EXISTS).requests == 1
+
+
+@pytest.mark.parametrize("codec", ["gzip", "zstd"])
+def test_transport_compression(tmp_path, codec):
+    try:
+        compress_file(__file__, tmp_path / "probe", codec)
+    except WorkflowError:
+        pytest.skip(f"{codec} not available")
+
+    class CompressingStorageProvider(DummyStorageProvider):
+        def __post_init__(self):
+            super().__post_init__()
+            self.metadata = dict()
+
+        def transport_compression(self) -> Optional[str]:
+            return codec
+
+    class CompressingStorageObject(DummyStorageObject):
+        def stat(self) -> StorageObjectStat:
+            if not self.exists():
+                return StorageObjectStat(exists=False)
+            return StorageObjectStat(
+                exists=True,
+                size=self.size(),
+                metadata=self.provider.metadata[self.query],
+            )
+
+        def store_object(self):
+            super().store_object()
+            self.provider.metadata[self.query] = self.transport_metadata()
+
+    provider = get_dummy_provider(tmp_path, CompressingStorageProvider)
+    obj = CompressingStorageObject(
+        query="dummy://data.tsv", keep_local=False, retrieve=True, provider=provider
+    )
+    content = "a\tb\tc\n" * 10000
+    obj.local_path().write_text(content)
+    asyncio.run(obj.managed_store())
+
+    stored, _ = provider.objects[obj.query]
+    assert len(stored) < len(content)
+    assert provider.metadata[obj.query][CODEC_METADATA_KEY] == codec
+    # no temporary files are left behind
+    assert list(provider.local_prefix.iterdir()) == [obj.local_path()]
+
+    assert asyncio.run(obj.managed_size()) == len(content)
+    assert asyncio.run(obj.managed_local_footprint()) == len(content)
+
+    obj.local_path().unlink()
+    asyncio.run(obj.managed_retrieve())
+    assert obj.local_path().read_text() == content
+
+
+def test_transport_compression_concurrent(tmp_path):
+    class CompressingStorageProvider(DummyStorageProvider):
+        def __post_init__(self):
+            super().__post_init__()
+            self.metadata = dict()
+
+        def transport_compression(self) -> Optional[str]:
+            return "gzip"
+
+    class CompressingStorageObject(DummyStorageObject):
+        def stat(self) -> StorageObjectStat:
+            if not self.exists():
+                return StorageObjectStat(exists=False)
+            return StorageObjectStat(
+                exists=True,
+                size=self.size(),
+                metadata=self.provider.metadata[self.query],
+            )
+
+        def checksum(self) -> Optional[str]:
+            content = self.provider.objects[self.query][0]
+            return f"sha256:{hashlib.sha256(content).hexdigest()}"
+
+        def store_object(self):
+            super().store_object()
+            self.provider.metadata[self.query] = self.transport_metadata()
+
+    provider = get_dummy_provider(
+        tmp_path,
+        CompressingStorageProvider,
+        settings=StorageProviderSettingsBase(
+            max_concurrent_requests=1, verify_checksums=True
+        ),
+    )
+    obj = CompressingStorageObject(
+        query="dummy://data.tsv", keep_local=False, retrieve=True, provider=provider
+    )
+    local_path = obj.local_path()
+    local_path.write_text("a\tb\tc\n" * 1000)
+
+    async def run(operation, transfer):
+        # other tasks do not see the temporary transport file while the
+        # transfer waits for a slot
+        scheduler = provider.scheduler(obj.query, operation)
+        async with scheduler.slot():
+            task = asyncio.create_task(transfer())
+            while not scheduler.waiting:
+                await asyncio.sleep(0.01)
+            assert obj.local_path() == local_path
+            assert obj.cache_key() == str(local_path)
+        await task
+
+    for _ in range(3):
+        asyncio.run(run(Operation.STORE, obj.managed_store))
+        local_path.unlink()
+        asyncio.run(run(Operation.RETRIEVE, obj.managed_retrieve))
+        assert obj.local_path() == local_path
+    # checksums of the temporary transport files are not cached
+    checksum_dir = provider.local_prefix / CHECKSUM_CACHE_DIR
+    assert not checksum_dir.exists() or not list(checksum_dir.iterdir())
+
+
+def test_compress_file_roundtrip(tmp_path):
+    src = tmp_path / "src.txt"
+    src.write_text("test" * 1000)
+    compress_file(src, tmp_path / "src.txt.gz", "gzip")
+    decompress_file(tmp_path / "src.txt.gz", tmp_path / "dst.txt", "gzip")
+    assert (tmp_path / "dst.txt").read_text() == src.read_text()
+    with pytest.raises(WorkflowError, match="Unsupported"):
+        compress_file(src, tmp_path / "src.txt.xz", "xz")
+
+
+def test_caching_storage_provider(tmp_path):
+    remote = get_dummy_provider(tmp_path)
+    provider = CachingStorageProvider(remote, tmp_path / "cache")
+    remote.objects["dummy://a.txt"] = (b"remote", time.time() - 100)
+
+    obj = provider.object("dummy://a.txt")
+    asyncio.run(obj.managed_retrieve())
+    assert obj.local_path().read_bytes() == b"remote"
+    assert (tmp_path / "cache" / "a.txt").read_bytes() == b"remote"
+
+    # same size and an older mtime: the cached copy is used
+    remote.objects["dummy://a.txt"] = (b"REMOTE", time.time() - 100)
+    obj = provider.object("dummy://a.txt")
+    obj.local_path().unlink()
+    asyncio.run(obj.managed_retrieve())
+    assert obj.local_path().read_bytes() == b"remote"
+
+    # modified remotely: the cached copy is invalid
+    remote.objects["dummy://a.txt"] = (b"updated", time.time() + 100)
+    obj = provider.object("dummy://a.txt")
+    obj.local_path().unlink()
+    asyncio.run(obj.managed_retrieve())
+    assert obj.local_path().read_bytes() == b"updated"
+    assert (tmp_path / "cache" / "a.txt").read_bytes() == b"updated"
+
+    # write-through
+    obj = provider.object("dummy://b.txt")
+    obj.local_path().write_bytes(b"output")
+    asyncio.run(obj.managed_store())
+    assert remote.objects["dummy://b.txt"][0] == b"output"
+    assert (tmp_path / "cache" / "b.txt").read_bytes() == b"output"
+
+
+def test_caching_storage_provider_write_back(tmp_path):
+    remote = get_dummy_provider(tmp_path)
+    provider = CachingStorageProvider(remote, tmp_path / "cache", write_back=True)
+
+    obj = provider.object("dummy://out.txt")
+    obj.local_path().write_bytes(b"output")
+    asyncio.run(obj.managed_store())
+    assert "dummy://out.txt" not in remote.objects
+    assert provider.pending_writes == ["dummy://out.txt"]
+    # answered from the cache tier until written back
+    obj = provider.object("dummy://out.txt")
+    assert asyncio.run(obj.managed_exists())
+    assert asyncio.run(obj.managed_size()) == len(b"output")
+
+    assert asyncio.run(provider.flush()) == {"dummy://out.txt": None}
+    assert remote.objects["dummy://out.txt"][0] == b"output"
+    assert provider.pending_writes == []
+
+    asyncio.run(obj.managed_remove())
+    assert "dummy://out.txt" not in remote.objects
+    assert not (tmp_path / "cache" / "out.txt").exists()
+
+
+def test_caching_storage_provider_write_back_failure(tmp_path):
+    class FailingStorageProvider(DummyStorageProvider):
+        def __post_init__(self):
+            super().__post_init__()
+            self.down = True
+
+        @classmethod
+        def get_storage_object_cls(cls):
+            return FailingStorageObject
+
+    class FailingStorageObject(DummyStorageObject):
+        def store_object(self):
+            if self.provider.down:
+                raise ConnectionError("endpoint down")
+            super().store_object()
+
+    remote = get_dummy_provider(tmp_path, FailingStorageProvider)
+    provider = CachingStorageProvider(remote, tmp_path / "cache", write_back=True)
+    obj = provider.object("dummy://out.txt")
+    obj.local_path().write_bytes(b"output")
+    asyncio.run(obj.managed_store())
+
+    # a failed write back remains pending
+    results = asyncio.run(provider.flush())
+    assert isinstance(results["dummy://out.txt"], WorkflowError)
+    assert provider.pending_writes == ["dummy://out.txt"]
+
+    # pending writes survive the process (e.g. a crash), another provider
+    # with the same cache directory sees and uploads them
+    del provider, obj
+    remote.down = False
+    provider = CachingStorageProvider(remote, tmp_path / "cache", write_back=True)
+    assert asyncio.run(provider.object("dummy://out.txt").managed_exists())
+    assert asyncio.run(provider.flush()) == {"dummy://out.txt": None}
+    assert remote.objects["dummy://out.txt"][0] == b"output"
+    assert provider.pending_writes == []
+
+
+def test_query_memoization(tmp_path):
+    calls = []
+
+    class NormalizingStorageProvider(DummyStorageProvider):
+        def postprocess_query(self, query: str) -> str:
+            calls.append(query)
+            return query.replace("dummy:///", "dummy://")
+
+    provider = get_dummy_provider(tmp_path, NormalizingStorageProvider)
+    queries = ["dummy:///a.txt", "dummy://b.txt", "dummy:///a.txt"]
+    assert provider.postprocess_queries(queries) == [
+        "dummy://a.txt",
+        "dummy://b.txt",
+        "dummy://a.txt",
+    ]
+    assert calls == ["dummy:///a.txt", "dummy://b.txt"]
+    # object() does not fill the memo
+    assert provider.object("dummy:///c.txt").query == "dummy://c.txt"
+    assert provider._postprocess_query_memoized.cache_info().currsize == 2
+
+    results = provider.validate_queries(["dummy://a.txt", "s3://b.txt"])
+    assert [bool(result) for result in results] == [True, False]
+
+
+def test_per_operation_class_limits(tmp_path):
+    class RateLimitedStorageProvider(DummyStorageProvider):
+        def use_rate_limiter(self) -> bool:
+            return True
+
+    settings = StorageProviderSettingsBase(
+        max_requests_per_second=10,
+        max_requests_per_second_store=2,
+        max_concurrent_requests=8,
+        max_concurrent_requests_metadata=32,
+    )
+    provider = get_dummy_provider(
+        tmp_path, RateLimitedStorageProvider, settings=settings
+    )
+    query = "dummy://foo.txt"
+
+    def limiter(operation):
+        return provider.rate_limiter(query, operation)
+
+    # store and touch share a separate limiter, all other operations the default
+    assert limiter(Operation.STORE) is limiter(Operation.TOUCH)
+    assert limiter(Operation.STORE) is not limiter(Operation.EXISTS)
+    assert limiter(Operation.EXISTS) is limiter(Operation.RETRIEVE)
+    assert limiter(Operation.STORE)._rate_limit == 2
+    assert limiter(Operation.EXISTS)._rate_limit == 10
+
+    def scheduler(operation):
+        return provider.scheduler(query, operation)
+
+    assert scheduler(Operation.EXISTS) is scheduler(Operation.SIZE)
+    assert scheduler(Operation.EXISTS).max_concurrent == 32
+    assert scheduler(Operation.RETRIEVE) is scheduler(Operation.STORE)
+    assert scheduler(Operation.RETRIEVE).max_concurrent == 8
+
+
+def test_transport_compression_requires_stat(tmp_path):
+    class CompressingStorageProvider(DummyStorageProvider):
+        def transport_compression(self) -> Optional[str]:
+            return "gzip"
+
+    provider = get_dummy_provider(tmp_path, CompressingStorageProvider)
+    obj = provider.object("dummy://data.tsv")
+    obj.local_path().write_text("a\tb\tc\n" * 100)
+    with pytest.raises(WorkflowError, match="has to implement stat"):
+        asyncio.run(obj.managed_store())
+    assert obj.query not in provider.objects